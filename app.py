@@ -1,18 +1,88 @@
 import markdown
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from mmap import mmap
 from flask import Flask, render_template, request, Response
+from werkzeug.wsgi import wrap_file
 from urllib.parse import urlparse
 
-from cache import Cache
+from cache import Cache, get_freshness
+from cost import QueryCost
 from elastic import ElasticQuery
 from examples import get_examples, get_example
 from query import Query
-from settings import DOCS_FILE
-from table import Table
-from exceptions import ValidationError
+from settings import DOCS_FILE, REVALIDATE_THREADS
+from table import Table, slice_entry, encode_orderings, load_orderings
+from exceptions import ValidationError, Overloaded, Timeout
+from workers import Workers, HeavyWorkers, materialize
 
 
 app = Flask(__name__)
 
+# background rebuilds of stale cached tables, at most one per table at a time
+revalidating = set()
+revalidating_lock = threading.Lock()
+revalidator = ThreadPoolExecutor(REVALIDATE_THREADS)
+
+
+def respond(content, mimetype, cache=None):
+    if isinstance(content, mmap):
+        # memory-mapped from the disk cache, streamed without copying it into a string first
+        response = Response(wrap_file(request.environ, content), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = len(content)
+    else:
+        response = Response(content, mimetype=mimetype)
+    # allow byte `Range` requests on every table response
+    if cache:
+        # `hit`: cached table, `base`: rendered from a cached base table, `miss`: built from elasticsearch,
+        # `stale`: from an outdated cache entry (while it is rebuilt or elasticsearch fails)
+        response.headers['X-Cache'] = cache
+        if cache == 'stale':
+            response.headers['Warning'] = '110 - "Response is Stale"'
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
+
+def respond_table(table, query, cache=None):
+    if query.paging:
+        return respond(table.paginated(*query.paging), table.mimetype, cache)
+    return respond(table.rendered(), table.mimetype, cache)
+
+
+def respond_expired(query, cache_hit, base_data, regions=None):
+    """
+    respond with the newer of the expired `cache_hit` and `base_data` if
+    elasticsearch fails, `None` if there is neither
+    """
+    page = None
+    if cache_hit and query.paging:
+        page = slice_entry(cache_hit, *query.paging)
+        if page is None:
+            cache_hit = None  # can't be paginated
+    entry = max(filter(None, (cache_hit, base_data)), key=lambda e: e['created'], default=None)
+    if entry is None:
+        return
+    if entry is base_data:
+        table = Table.from_base(base_data, query, regions=regions, orderings=load_orderings(base_data))
+        return respond_table(table, query, 'stale')
+    return respond(cache_hit['content'] if page is None else page, cache_hit['mimetype'], 'stale')
+
+
+def revalidate(query):
+    """rebuild the cached table of `query` and its base table from elasticsearch in the background"""
+    with revalidating_lock:
+        if query.key in revalidating:
+            return
+        revalidating.add(query.key)
+
+    def done(future):
+        revalidating.discard(query.key)
+        if future.exception():
+            app.logger.warning('revalidating `%s` failed: %r', query.urlquery, future.exception())
+
+    # estimated and processed in the worker pools like a request, so that heavy tables use their lane
+    revalidator.submit(materialize, [query], force=True, lanes=True).add_done_callback(done)
+
 
 @app.route('/docs/')
 def docs():
@@ -45,25 +115,79 @@ def api():
         if not app.debug or 'cache' in request.args:
             # we use elasticsearch as a cache backend where we store raw text strings
             cache_hit = Cache.get(q.key)
-            if cache_hit:
-                return Response(cache_hit['content'], mimetype=cache_hit['mimetype'])
-
-            # try to get the base table (no format/transform) from cache:
-            base_data = Cache.get(q.data_key)
-            if base_data:
-                table = Table.from_base(base_data, q)
-
-            else:
-                # nothing in cache, so create the table
-                es = ElasticQuery(q.cleaned_data)
-                table = Table(es.facts, q)
-
-            # store in cache for later use
-            Cache.set(q.key, table.serialize())
-            if base_data is None:
-                Cache.set(q.data_key, table.serialize_base())
-
-            return Response(table.rendered(), mimetype=table.mimetype)
+            freshness = cache_hit and get_freshness(cache_hit)
+            if freshness in ('fresh', 'stale'):
+                cache = 'hit'
+                if freshness == 'stale':
+                    # served as it is while it is rebuilt in the background
+                    cache = 'stale'
+                    revalidate(q)
+                if not q.paging:
+                    return respond(cache_hit['content'], cache_hit['mimetype'], cache)
+                # slice the requested page out of the cached content
+                page = slice_entry(cache_hit, *q.paging)
+                if page is not None:
+                    return respond(page, cache_hit['mimetype'], cache)
+
+            # the lane of a heavy query is released after its table is processed
+            pool = Workers
+            cache = 'base'
+            # expired entries are only served if elasticsearch fails
+            expired_hit = cache_hit if freshness == 'expired' else None
+            expired_base = None
+            with ExitStack() as lane:
+                # try to get the base table (no format/transform) from cache,
+                # a cached base table for all regions of the same level can be filtered locally
+                base_data = Cache.get(q.data_key)
+                regions = None
+                if not base_data and q.superset_data_key:
+                    base_data = Cache.get(q.superset_data_key)
+                    regions = q.region_ids
+                if base_data and get_freshness(base_data) == 'expired':
+                    expired_base, base_data = base_data, None
+
+                if base_data:
+                    orderings = load_orderings(base_data)
+                    stored = set(orderings)
+                    table = Table.from_base(base_data, q, regions=regions, orderings=orderings)
+                    if get_freshness(base_data) == 'stale':
+                        cache = 'stale'
+                        revalidate(q)
+
+                else:
+                    # nothing in cache, so estimate the query and create the table
+                    cache = 'miss'
+                    try:
+                        es = ElasticQuery(q.cleaned_data)
+                        cost = QueryCost(q, es)
+                        cost.validate()
+                        if cost.heavy:
+                            # heavy queries hold a slot of their own lane from scanning to rendering
+                            pool = HeavyWorkers
+                            lane.enter_context(pool.slot())
+                        table = Table(es.facts, q)
+                    except Timeout:
+                        response = respond_expired(q, expired_hit, expired_base, regions)
+                        if response is None:
+                            raise
+                        return response
+
+                # large tables are processed in the worker pool (if enabled)
+                concrete, base, page = pool.process(table, q.paging, with_base=base_data is None,
+                                                    reserved=pool is HeavyWorkers)
+
+                # store in cache for later use, tables from stale entries are stored by their rebuild
+                if cache != 'stale':
+                    if cache_hit is None or freshness == 'expired':
+                        Cache.set(q.key, concrete)
+                    if base is not None:
+                        Cache.set(q.data_key, base)
+                    elif regions is None and set(table._orderings) - stored:
+                        # keep the orderings sorted for this table with its base table
+                        Cache.update(q.data_key, {
+                            'orderings': encode_orderings(table._orderings, base_data['created'])})
+
+                return respond(page if q.paging else concrete['content'], concrete['mimetype'], cache)
 
         else:
             try:
@@ -76,12 +200,21 @@ def api():
                 return {
                     'data': q.cleaned_data,
                     'query_body': es.body,
+                    'estimate': QueryCost(q, es).as_dict(),
                     'table': data
                 }
             es = ElasticQuery(q.cleaned_data)
             table = Table(es.facts, q)
-            return Response(table.rendered(), mimetype=table.mimetype)
+            return respond_table(table, q)
     except ValidationError as e:
         return {
             'error': str(e)
         }
+    except Overloaded as e:
+        return {
+            'error': str(e)
+        }, 503, {'Retry-After': '30'}
+    except Timeout as e:
+        return {
+            'error': str(e)
+        }, 504, {'Retry-After': '30'}
@@ -1,8 +1,34 @@
-from datetime import datetime
+import json
+import mmap
+import os
+import time
+from datetime import datetime, timedelta
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 
-from settings import ELASTIC_CACHE_INDEX, ELASTIC_HOST, ELASTIC_AUTH
+from settings import (ELASTIC_CACHE_INDEX, ELASTIC_HOST, ELASTIC_AUTH,
+                      DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_MAX_AGE, CACHE_MAX_AGE, CACHE_MAX_STALE)
+
+
+# large fields of the cache entries, stored as separate files by the `DiskBackend`
+BODY_FIELDS = ('content', 'blob')
+
+
+def get_freshness(body):
+    """
+    `fresh`, `stale` (served while it is rebuilt) or `expired` (only served
+    if elasticsearch fails), judged by the `expires` of the entry
+    """
+    if 'expires' in body:
+        expires = datetime.fromisoformat(body['expires'])
+    else:  # stored before entries expired
+        expires = datetime.fromisoformat(body['created']) + timedelta(seconds=CACHE_MAX_AGE)
+    now = datetime.now()
+    if now < expires:
+        return 'fresh'
+    if now < expires + timedelta(seconds=CACHE_MAX_STALE):
+        return 'stale'
+    return 'expired'
 
 
 class ElasticsearchBackend:
@@ -17,19 +43,196 @@ class ElasticsearchBackend:
             return
 
     def set(self, id_, body):
-        body['created'] = datetime.now().isoformat()
         return self.client.index(index=self.index, id=id_, body=body)
 
+    def update(self, id_, fields):
+        try:
+            return self.client.update(index=self.index, id=id_, body={'doc': fields})
+        except NotFoundError:
+            return
+
+    def delete(self, id_):
+        try:
+            return self.client.delete(index=self.index, id=id_)
+        except NotFoundError:
+            return
+
+
+class DiskBackend:
+    """
+    host-local cache on disk, shared by all worker processes of a host. the
+    body (`content` or `blob`) of every entry is a file of its own that is
+    returned memory-mapped, so it is not copied into memory until it is
+    sent. every write of an entry gets a new body file named after the time
+    it was stored, the `.json` file references it, so a reader never pairs
+    the metadata of one write with the body of another. the least recently
+    used entries and the bodies of replaced writes are evicted beyond
+    `max_bytes`, entries stored here more than `max_age` seconds ago are
+    ignored.
+    """
+    grace = 60  # seconds a replaced body is kept for readers still mapping it
+
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._written = max_bytes  # check the size of the cache at the first write
+        os.makedirs(path, exist_ok=True)
+
+    def _fp(self, id_, ext):
+        return os.path.join(self.path, id_[:2], f'{id_}.{ext}')
+
+    def get(self, id_):
+        try:
+            with open(self._fp(id_, 'json')) as f:
+                body = json.load(f)
+            # the local age, entries copied from elasticsearch keep their `created`
+            if body.pop('_stored') < time.time() - self.max_age:
+                return
+            field, version = body.pop('_body', (None, None))
+            if field:
+                with open(self._fp(id_, f'{version}.body'), 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    # the mapping stays valid if the file is evicted meanwhile
+                    body[field] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            os.utime(self._fp(id_, 'json'))  # recently used
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        return body
+
+    def set(self, id_, body):
+        body = dict(body)
+        field = next((f for f in BODY_FIELDS if f in body), None)
+        size = 0
+        stored = time.time()
+        os.makedirs(os.path.dirname(self._fp(id_, 'json')), exist_ok=True)
+        if field:
+            data = body.pop(field)
+            data = data.encode() if isinstance(data, str) else bytes(data)
+            version = f'{int(stored * 1e6)}-{os.getpid()}'
+            size = self._write(self._fp(id_, f'{version}.body'), data)
+            body['_body'] = (field, version)
+        body['_stored'] = stored
+        # the entry exists once its `.json` file exists, so it is written last
+        size += self._write(self._fp(id_, 'json'), json.dumps(body).encode())
+        self._written += size
+        if self._written > self.max_bytes / 10:
+            self.evict()
+
+    def update(self, id_, fields):
+        """add the (small, non-body) `fields` to the entry, keeping its body and local age"""
+        fp = self._fp(id_, 'json')
+        try:
+            with open(fp) as f:
+                body = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        body.update(fields)
+        self._write(fp, json.dumps(body).encode())
+
+    def _write(self, fp, data):
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, fp)
+        return len(data)
+
+    def delete(self, id_):
+        directory = os.path.dirname(self._fp(id_, 'json'))
+        try:
+            files = [f.path for f in os.scandir(directory) if f.name.split('.')[0] == id_]
+        except FileNotFoundError:
+            return
+        for fp in files:
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        remove the bodies of replaced writes, then the least recently used
+        entries until the cache is below 90% of `max_bytes`
+        """
+        self._written = 0
+        entries = {}
+        bodies = {}  # id -> [(version, mtime, size, path)]
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for file in os.scandir(directory.path):
+                id_, _, ext = file.name.partition('.')
+                if ext != 'json' and not ext.endswith('.body'):
+                    continue
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                if ext == 'json':
+                    used, size = entries.get(id_, (0, 0))
+                    entries[id_] = (max(used, stat.st_mtime), size + stat.st_size)
+                else:
+                    version = tuple(map(int, ext[:-len('.body')].split('-')))
+                    bodies.setdefault(id_, []).append((version, stat.st_mtime, stat.st_size, file.path))
+        orphaned = time.time() - self.grace
+        for id_, files in bodies.items():
+            files.sort()
+            # the latest body belongs to the `.json` file, unless there is none
+            keep = files[-1:] if id_ in entries else []
+            for _, mtime, size, fp in files[:len(files) - len(keep)]:
+                if mtime < orphaned:
+                    try:
+                        os.remove(fp)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    keep.append((None, mtime, size, fp))
+            if id_ in entries:
+                used, size = entries[id_]
+                entries[id_] = (used, size + sum(f[2] for f in keep))
+        total = sum(size for _, size in entries.values())
+        for id_, (_, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if total <= self.max_bytes * 0.9:
+                break
+            self.delete(id_)
+            total -= size
+
 
 class BaseCache:
-    def __init__(self, backend):
+    """
+    `backend` (elasticsearch) with optional faster `tiers` in front of it,
+    hits in a lower tier are copied into the tiers above
+    """
+    def __init__(self, backend, tiers=()):
         self.backend = backend
+        self.tiers = list(tiers)
 
     def get(self, id_):
-        return self.backend.get(id_)
+        for i, backend in enumerate(self.tiers + [self.backend]):
+            body = backend.get(id_)
+            if body:
+                for tier in self.tiers[:i]:
+                    tier.set(id_, body)
+                return body
 
     def set(self, id_, body):
-        return self.backend.set(id_, body)
+        created = datetime.now()
+        body['created'] = created.isoformat()
+        body['expires'] = (created + timedelta(seconds=CACHE_MAX_AGE)).isoformat()
+        for backend in self.tiers + [self.backend]:
+            backend.set(id_, body)
+
+    def update(self, id_, fields):
+        """add `fields` to an existing entry, it keeps its `created` and `expires`"""
+        for backend in self.tiers + [self.backend]:
+            backend.update(id_, fields)
+
+    def delete(self, id_):
+        for backend in self.tiers + [self.backend]:
+            backend.delete(id_)
 
 
-Cache = BaseCache(ElasticsearchBackend())
+Cache = BaseCache(
+    ElasticsearchBackend(),
+    tiers=[DiskBackend(DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_MAX_AGE)] if DISK_CACHE_DIR else []
+)
@@ -0,0 +1,106 @@
+"""
+estimate the size of a query before scanning its facts
+"""
+
+
+from collections import Counter
+
+from exceptions import ValidationError
+from schema import Regions, Schema
+from settings import (QUERY_MAX_ROWS, QUERY_HEAVY_ROWS, QUERY_COUNT_MIN_ROWS,
+                      ESTIMATE_YEARS, ESTIMATE_ROW_BYTES)
+from util import cached_property
+
+
+REGION_COUNTS = Counter(Regions.levels.values())
+
+
+class QueryCost:
+    """
+    an upper bound of the rows from the schema (regions x years x dimension
+    value combinations per measure) and, only for queries that might be
+    large, a cheap elasticsearch `count` on the compiled query
+    """
+    def __init__(self, query, es):
+        self.query = query
+        self.es = es
+        self.data = query.cleaned_data
+
+    @cached_property
+    def regions(self):
+        if self.query.region_ids is not None:
+            return len(self.query.region_ids)
+        level = self.data['level']
+        if level == 'all':
+            return len(Regions.levels)
+        return sum(REGION_COUNTS[int(l)] for l in (level.split(',') if isinstance(level, str) else level))
+
+    @cached_property
+    def years(self):
+        time = self.data['time']
+        if time == 'latest':
+            return 1
+        if time == 'all':
+            return ESTIMATE_YEARS
+        if isinstance(time, list):
+            return len(time)
+        if ':' in time:
+            start, end = time.split(':')
+            if start and end:
+                return max(int(end) - int(start) + 1, 0)
+            return ESTIMATE_YEARS
+        return 1
+
+    @cached_property
+    def combinations(self):
+        """number of dimension value combinations, summed up for all measures"""
+        combinations = 0
+        for statistic, measures in self.data['data'].items():
+            for measure, dimensions in measures.items():
+                n = 1
+                for dimension, values in dimensions.items():
+                    n *= len(values) or sum(1 for _ in Schema[statistic][measure][dimension])
+                combinations += n
+        return combinations
+
+    @cached_property
+    def schema_rows(self):
+        return self.regions * self.years * self.combinations
+
+    @cached_property
+    def facts(self):
+        """the exact number of matching facts, only counted if the schema estimate is not small"""
+        if self.schema_rows < QUERY_COUNT_MIN_ROWS:
+            return
+        return self.es.count()
+
+    @cached_property
+    def rows(self):
+        return self.schema_rows if self.facts is None else self.facts
+
+    @cached_property
+    def bytes(self):
+        dimensions = sum(len(dims) for measures in self.data['data'].values() for dims in measures.values())
+        row_bytes = ESTIMATE_ROW_BYTES + 12 * dimensions
+        if self.data['labels'] != 'id':
+            row_bytes *= 2
+        return self.rows * row_bytes
+
+    @cached_property
+    def heavy(self):
+        return self.rows >= QUERY_HEAVY_ROWS
+
+    def validate(self):
+        if self.rows > QUERY_MAX_ROWS:
+            raise ValidationError(f'Query too large: about {self.rows} rows (max. {QUERY_MAX_ROWS}). '
+                                  'Please narrow it down via `region`, `level`, `parent` or `time`.')
+        return True
+
+    def as_dict(self):
+        return {
+            'schema_rows': self.schema_rows,
+            'facts': self.facts,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'heavy': self.heavy
+        }
@@ -1,9 +1,20 @@
+import json
+import time
+from functools import lru_cache
+
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionTimeout
 from elasticsearch.helpers import scan
 
-from schema import Schema
-from settings import ELASTIC_HOST, ELASTIC_INDEX, ELASTIC_AUTH
-from util import cached_property
+from exceptions import Timeout
+from schema import Schema, Regions, ROOT_REGION
+from settings import (ELASTIC_HOST, ELASTIC_INDEX, ELASTIC_AUTH, LATEST_YEAR_CACHE_TTL, REGION_TERMS_MAX,
+                      MEASURE_FILTER_CACHE_SIZE, ELASTIC_TIMEOUT, ELASTIC_SCAN_DEADLINE)
+from util import cached_property, TTLCache
+
+
+# resolved `time=latest` years per statistic (and meta filters), see `ElasticQuery.latest_years`
+LATEST_YEARS = TTLCache(LATEST_YEAR_CACHE_TTL)
 
 
 def get_term_filter(field, terms):
@@ -14,13 +25,80 @@ def get_term_filter(field, terms):
     return {'term': {field: terms}}
 
 
+def freeze_dimensions(dimensions):
+    """hashable form of a dimension selection `{dimension: [values]}`"""
+    return tuple(sorted((dimension, tuple(sorted(values))) for dimension, values in dimensions.items()))
+
+
+def get_dimension_filter(measure, dimension, values):
+    field = 'path.%s.%s' % (measure, dimension)
+    if not values:
+        return {'exists': {'field': field}}
+    return {'terms': {'%s.keyword' % field: list(values)}}
+
+
+@lru_cache(maxsize=MEASURE_FILTER_CACHE_SIZE)
+def compile_measure_filter(statistic, measure, dimensions):
+    """
+    filter for the facts of `measure` with exactly the selected `dimensions`
+    (see `freeze_dimensions`), memoised: the returned dict is shared and
+    must not be modified.
+
+    the values of a dimension are restricted either by excluding all other
+    values of the schema (`must_not terms`) or, if that is the longer list,
+    by allowing only the selected ones (or facts without this dimension)
+    """
+    dimensions = dict(dimensions)
+    schema = Schema[statistic][measure]
+    other_dimensions = sorted(set(d.key for d in schema) - set(dimensions.keys()))
+    if not dimensions:
+        return {'bool': {
+            'must': {'exists': {'field': measure}},
+            'must_not': [{'exists': {'field': d}} for d in other_dimensions]
+        }}
+    # exclude other dimensions
+    must_not = [{'exists': {'field': 'path.%s.%s' % (measure, d)}} for d in other_dimensions]
+    must = []
+    for dimension, values in dimensions.items():
+        if not values:
+            continue
+        field = 'path.%s.%s' % (measure, dimension)
+        excluded = sorted(set(v.key for v in schema[dimension]) - set(values))
+        if not excluded or len(dimensions) == 1:
+            # all values selected, or already required by the only `should` clause
+            continue
+        if len(values) < len(excluded):
+            must.append({'bool': {'should': [
+                {'terms': {'%s.keyword' % field: list(values)}},
+                {'bool': {'must_not': {'exists': {'field': field}}}}
+            ]}})
+        else:
+            must_not.append({'terms': {'%s.keyword' % field: excluded}})
+    measure_filter = {
+        'should': [get_dimension_filter(measure, dimension, values) for dimension, values in dimensions.items()],
+        'must_not': must_not
+    }
+    if must:
+        # with `must` clauses, `should` clauses are optional unless required explicitly
+        measure_filter['must'] = must
+        measure_filter['minimum_should_match'] = 1
+    return {'bool': measure_filter}
+
+
 class ElasticQuery:
-    def __init__(self, data):
+    def __init__(self, data, cubes=None):
         self.data = data
-        self.client = Elasticsearch([ELASTIC_HOST], http_auth=ELASTIC_AUTH)
+        self.cubes = cubes  # only facts of these cubes, to refresh cached tables
+        self.client = Elasticsearch([ELASTIC_HOST], http_auth=ELASTIC_AUTH, timeout=ELASTIC_TIMEOUT)
 
     def execute(self):
-        return scan(self.client, index=[ELASTIC_INDEX], query=self.body)
+        return scan(self.client, index=[ELASTIC_INDEX], query=self.body, request_timeout=ELASTIC_TIMEOUT)
+
+    def count(self):
+        try:
+            return self.client.count(index=[ELASTIC_INDEX], body={'query': self.body['query']})['count']
+        except ConnectionTimeout as e:
+            raise Timeout('elasticsearch timed out') from e
 
     @cached_property
     def result(self):
@@ -28,8 +106,15 @@ class ElasticQuery:
 
     @cached_property
     def facts(self):
-        for hit in self.result:
-            yield hit['_source']
+        # every request has its `ELASTIC_TIMEOUT`, all of them together `ELASTIC_SCAN_DEADLINE`
+        deadline = time.monotonic() + ELASTIC_SCAN_DEADLINE
+        try:
+            for hit in self.result:
+                if time.monotonic() > deadline:
+                    raise Timeout('elasticsearch did not return all facts within %ss' % ELASTIC_SCAN_DEADLINE)
+                yield hit['_source']
+        except ConnectionTimeout as e:
+            raise Timeout('elasticsearch timed out') from e
 
     @cached_property
     def body(self):
@@ -48,7 +133,11 @@ class ElasticQuery:
         }
 
     def get_meta_filters(self):
-        return self.get_regions(), self.get_time(), self.get_region_level(), self.get_parent()
+        return self.get_regions(), self.get_time(), self.get_region_level(), self.get_parent(), self.get_cubes()
+
+    def get_cubes(self):
+        if self.cubes:
+            return get_term_filter('cube', list(self.cubes))
 
     def get_regions(self):
         data = self.data['region']
@@ -57,13 +146,68 @@ class ElasticQuery:
         return get_term_filter('region_id', data)
 
     def get_region_level(self):
-        if self.data['region'] == 'all':
+        if self.data['region'] == 'all' and self.data['level'] != 'all':
             return get_term_filter('region_level', self.data['level'])
 
     def get_parent(self):
         data = self.data['parent']
-        if data:
-            return {'prefix': {'region_id': data}}
+        if not data or data == ROOT_REGION:  # every region is below the root region
+            return
+        # exact region ids from the region index are cheaper than a prefix query
+        level = self.data['level'] if self.data['region'] == 'all' else 'all'
+        regions = Regions.get_regions(data, level)
+        if regions and len(regions) <= REGION_TERMS_MAX:
+            return get_term_filter('region_id', sorted(regions))
+        return {'prefix': {'region_id': data}}
+
+    @cached_property
+    def latest_years(self):
+        """
+        resolve `time=latest` to the latest available year per statistic and
+        measure (within the region filters) via a terms aggregation ahead of
+        the actual scan, cached per statistic for `LATEST_YEAR_CACHE_TTL` seconds
+        """
+        if self.data['time'] != 'latest':
+            return {}
+        filters = [f for f in self.get_meta_filters() if f]
+        filters_key = json.dumps(filters, sort_keys=True)
+        latest_years = {}
+        keys = {}
+        aggs = {}
+        for statistic, measures in self.data['data'].items():
+            # the measure filters follow from the selected dimensions
+            key = (filters_key, statistic, tuple(sorted((measure, freeze_dimensions(dimensions))
+                                                        for measure, dimensions in measures.items())))
+            years = LATEST_YEARS.get(key)
+            if years is not None:
+                latest_years[statistic] = years
+                continue
+            keys[statistic] = key
+            measure_filters = {measure: self.get_measure_filter(statistic, measure, dimensions)
+                               for measure, dimensions in measures.items()}
+            aggs[statistic] = {
+                'filter': {'term': {'statistic': statistic}},
+                'aggs': {measure: {
+                    'filter': measure_filter,
+                    'aggs': {'year': {'terms': {'field': 'year', 'size': 1, 'order': {'_key': 'desc'}}}}
+                } for measure, measure_filter in measure_filters.items()}
+            }
+        if aggs:
+            body = {
+                'size': 0,
+                'query': {'constant_score': {'filter': {'bool': {'must': filters}}}},
+                'aggs': aggs
+            }
+            res = self.client.search(index=ELASTIC_INDEX, body=body)
+            for statistic in aggs:
+                result = res['aggregations'][statistic]
+                years = {}
+                for measure in self.data['data'][statistic]:
+                    buckets = result[measure]['year']['buckets']
+                    years[measure] = buckets[0]['key'] if buckets else None
+                latest_years[statistic] = years
+                LATEST_YEARS.set(keys[statistic], years)
+        return latest_years
 
     def get_time(self):
         data = self.data['time']
@@ -83,36 +227,16 @@ class ElasticQuery:
         for statistic, measures in self.data['data'].items():
             yield {'bool': {'must': [
                 {'term': {'statistic': statistic}},
-                {'bool': {'should': [self.get_measure_filter(measure, dimensions, Schema[statistic])
-                                     for measure, dimensions in measures.items()]}}
+                {'bool': {'should': [
+                    self.get_latest_filter(statistic, measure, self.get_measure_filter(statistic, measure, dimensions))
+                    for measure, dimensions in measures.items()]}}
             ]}}
 
-    def get_measure_filter(self, measure, dimensions, schema):
-        other_dimensions = set(d.key for d in schema[measure]) - set(dimensions.keys())
-        if not dimensions:
-            return {'bool': {
-                'must': {'exists': {'field': measure}},
-                'must_not': [{'exists': {'field': d}} for d in other_dimensions]
-            }}
-        else:
-            not_values = {}
-            for dimension, values in dimensions.items():
-                if values:
-                    not_values['path.%s.%s.keyword' % (measure, dimension)] = list(
-                        set(v.key for v in schema[measure][dimension]) - set(values))
-            return {
-                'bool': {
-                    'should': [self.get_dimension_filter(measure, dimension, values)
-                               for dimension, values in dimensions.items()],
-                    # eclude other dimensions and values
-                    'must_not': [{'exists': {'field': 'path.%s.%s' % (measure, other_dimension)}}
-                                 for other_dimension in other_dimensions] + [
-                                     {'terms': {k: v}} for k, v in not_values.items()]
-                }
-            }
+    def get_latest_filter(self, statistic, measure, measure_filter):
+        year = self.latest_years.get(statistic, {}).get(measure)
+        if year is None:  # not `time=latest` or no data at all for this measure
+            return measure_filter
+        return {'bool': {'must': [measure_filter, {'term': {'year': year}}]}}
 
-    def get_dimension_filter(self, measure, dimension, values):
-        field = 'path.%s.%s' % (measure, dimension)
-        if not values:
-            return {'exists': {'field': field}}
-        return {'terms': {'%s.keyword' % field: values}}
+    def get_measure_filter(self, statistic, measure, dimensions):
+        return compile_measure_filter(statistic, measure, freeze_dimensions(dimensions))
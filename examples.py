@@ -3,67 +3,79 @@ render random examples from the elastic cache
 """
 
 
-import csv
+import random
 from flask import request
 
 from cache import Cache
 from schema import Schema
-from settings import GENESAPI_TABULAR_STATIC
+from settings import GENESAPI_TABULAR_STATIC, EXAMPLES_CACHE_TTL
+from table import decode_offsets, get_preview
+from util import TTLCache
 
 
 client = Cache.backend.client
 index = Cache.backend.index
 
+# only these fields are needed to render an example, not the whole `content`
+PREVIEW_FIELDS = ['definition', 'urlquery', 'preview']
+EXAMPLES = TTLCache(EXAMPLES_CACHE_TTL)
 
-def serialize_example(id_, data):
-    schema = Schema.get_filtered_for_query(data['definition']['data'])
 
-    def get_rows():
-        for i, row in enumerate(data['content'].split('\n')):
-            yield row
-            if i > 10:
-                return
+def load_preview(id_, data):
+    if 'preview' not in data:
+        # entries cached before previews were stored
+        source = client.get_source(index=index, id=id_, _source_includes=['content', 'row_offsets'])
+        schema = Schema.get_filtered_for_query(data['definition']['data'])
+        row_offsets = decode_offsets(source['row_offsets']) if 'row_offsets' in source else None
+        data['preview'] = get_preview(source['content'], data['definition']['delimiter'], schema, row_offsets)
+    return data['preview']
 
-    rows = [r for r in get_rows()]
-    delimiter = data['definition']['delimiter']
+
+def serialize_example(id_, data):
+    schema = Schema.get_filtered_for_query(data['definition']['data'])
+    preview = load_preview(id_, data)
 
     return {
         'id': id_,
-        'title': ' / '.join(s.title_de for s in schema),
-        'subtitle': ', '.join(m.title_de for s in schema for m in s),
+        'title': preview['title'],
+        'subtitle': preview['subtitle'],
         'schema': schema,
         'url': '%s?%s' % (request.host_url, data['urlquery']),
         'static_url': '%s/?%s' % (GENESAPI_TABULAR_STATIC, data['urlquery']),
         'table': {
-            'header': [r for r in csv.reader(rows[:1], delimiter=delimiter)][0],
-            'rows': csv.reader(rows[1:], delimiter=delimiter)
+            'header': preview['header'],
+            'rows': preview['rows']
         },
         'params': ((k, v) for k, v in data['definition'].items() if k != 'data' and v)
     }
 
 
 def get_example(id_):
-    example = client.get(index=index, id=id_)
+    example = client.get(index=index, id=id_, _source_includes=PREVIEW_FIELDS)
     return [serialize_example(id_, example['_source'])]
 
 
 def get_examples():
-    # get a randomized list of 10 examples
-    query = {
-        'bool': {
-            'filter': [
-                {'term': {'kind': 'concrete'}},
-                {'term': {'definition.format': 'csv'}}
-            ]
-        }
-    }
-    sort = {
-        '_script': {
-            'script': 'Math.random()',
-            'type': 'number',
-            'order': 'asc'
+    # get a randomized list of 10 examples, kept for `EXAMPLES_CACHE_TTL` seconds
+    examples = EXAMPLES.get('examples')
+    if examples is None:
+        query = {
+            'function_score': {
+                'query': {
+                    'bool': {
+                        'filter': [
+                            {'term': {'kind': 'concrete'}},
+                            {'term': {'definition.format': 'csv'}}
+                        ]
+                    }
+                },
+                # cheap per-document hash instead of sorting the whole index by a script
+                'random_score': {'seed': random.randint(0, 2 ** 31), 'field': '_seq_no'},
+                'boost_mode': 'replace'
+            }
         }
-    }
-    examples = client.search(index=index, body={'query': query, 'sort': sort})
-    for example in examples['hits']['hits']:
+        examples = client.search(index=index, body={'query': query, 'size': 10, '_source': PREVIEW_FIELDS})
+        examples = examples['hits']['hits']
+        EXAMPLES.set('examples', examples)
+    for example in examples:
         yield serialize_example(example['_id'], example['_source'])
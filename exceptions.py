@@ -1,2 +1,10 @@
 class ValidationError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
@@ -0,0 +1,177 @@
+"""
+bulk export of tables to static files (for the static mirror)
+
+    python export.py --out ./static-export queries.txt
+    python export.py --out ./static-export --cached --processes 8
+
+the queries (one urlquery per line, or all cached concrete entries) are
+grouped by their base table, so every base table is fetched and built only
+once, and every format x layout x labels variant is rendered from it. the
+files are written by worker processes into a content-addressed tree
+(`<out>/ab/cdef....csv`), `<out>/manifest.json` maps every table key to its
+urlquery and file.
+"""
+
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from hashlib import sha1
+from itertools import product
+from multiprocessing import get_context
+from urllib.parse import parse_qsl, urlencode
+
+from elasticsearch.helpers import scan
+
+from cache import Cache
+from elastic import ElasticQuery
+from exceptions import ValidationError
+from query import Query
+from settings import EXPORT_PROCESSES
+from table import Table, load_orderings
+
+
+VARIANT_ARGS = ('format', 'layout', 'labels')
+# `labels=both` is not rendered by `Table.labelize` yet
+VARIANTS = {
+    'format': ['csv', 'tsv', 'json'],
+    'layout': ['long', 'region', 'time'],
+    'labels': ['id', 'name']
+}
+
+
+def get_variants(urlquery, formats=None, layouts=None, labels=None):
+    """urlqueries of all format x layout x labels variants of `urlquery`"""
+    params = [(k, v) for k, v in parse_qsl(urlquery) if k not in VARIANT_ARGS]
+    for variant in product(formats or VARIANTS['format'],
+                           layouts or VARIANTS['layout'],
+                           labels or VARIANTS['labels']):
+        yield urlencode(params + list(zip(VARIANT_ARGS, variant)), safe=':(),;')
+
+
+def get_cached_queries():
+    """urlqueries of all concrete entries of the cache index"""
+    for hit in scan(Cache.backend.client, index=Cache.backend.index, _source=['urlquery'],
+                    query={'query': {'term': {'kind': 'concrete'}}}):
+        yield hit['_source']['urlquery']
+
+
+def group_queries(urlqueries, **variants):
+    """urlqueries of all variants, grouped by the key of their base table"""
+    groups = defaultdict(dict)
+    for urlquery in urlqueries:
+        for variant in get_variants(urlquery, **variants):
+            try:
+                query = Query(variant)
+                groups[query.data_key][query.key] = variant
+            except ValidationError as e:
+                print(f'skipping `{variant}`: {e}', file=sys.stderr)
+    return {k: list(v.values()) for k, v in groups.items()}
+
+
+def write_file(out, content, extension):
+    """write `content` to its content-addressed path below `out`, returns the relative path"""
+    content = content.encode() if isinstance(content, str) else content
+    digest = sha1(content).hexdigest()
+    path = os.path.join(digest[:2], f'{digest[2:]}.{extension}')
+    fp = os.path.join(out, path)
+    if not os.path.exists(fp):
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, fp)
+    return path, len(content)
+
+
+def export_group(urlqueries, out):
+    """
+    render all `urlqueries` (sharing one base table) to files, returns the
+    manifest entries and the errors
+    """
+    queries = [Query(q) for q in urlqueries]
+    base_data = Cache.get(queries[0].data_key)
+    # the rows of the base table are sorted once per `sort` and `labels`
+    orderings = load_orderings(base_data) if base_data else {}
+    entries, errors = {}, {}
+    for query in queries:
+        try:
+            if base_data:
+                table = Table.from_base(base_data, query, orderings=orderings)
+            else:
+                table = Table(ElasticQuery(query.cleaned_data).facts, query, orderings=orderings)
+            path, size = write_file(out, table.rendered(), table.format)
+            if not base_data:
+                base_data = table.serialize_base()
+        except Exception as e:
+            errors[query.urlquery] = repr(e)
+            continue
+        entries[query.key] = {
+            'urlquery': query.urlquery,
+            'file': path,
+            'mimetype': table.mimetype,
+            'bytes': size
+        }
+    return entries, errors
+
+
+def write_manifest(out, entries):
+    fp = os.path.join(out, 'manifest.json')
+    manifest = {}
+    if os.path.exists(fp):  # keep the entries of earlier (partial) exports
+        with open(fp) as f:
+            manifest = json.load(f)
+    manifest.update(entries)
+    with open(f'{fp}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f'{fp}.tmp', fp)
+
+
+def export(urlqueries, out, processes=EXPORT_PROCESSES, **variants):
+    groups = group_queries(urlqueries, **variants)
+    os.makedirs(out, exist_ok=True)
+    entries, errors = {}, {}
+    started = time.monotonic()
+    # `spawn`: don't share the elasticsearch connections of this process with the workers
+    with ProcessPoolExecutor(processes, mp_context=get_context('spawn')) as executor:
+        futures = {executor.submit(export_group, queries, out): key for key, queries in groups.items()}
+        for i, future in enumerate(as_completed(futures), 1):
+            try:
+                group_entries, group_errors = future.result()
+            except Exception as e:
+                group_entries, group_errors = {}, {q: repr(e) for q in groups[futures[future]]}
+            entries.update(group_entries)
+            errors.update(group_errors)
+            print(f'[{i}/{len(groups)}] {len(entries)} files, {len(errors)} failed, '
+                  f'{len(entries) / (time.monotonic() - started):.1f} files/s', file=sys.stderr)
+    write_manifest(out, entries)
+    return entries, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export tables to static files')
+    parser.add_argument('queries', nargs='?', type=argparse.FileType('r'), help='file with one urlquery per line')
+    parser.add_argument('--cached', action='store_true', help='export all cached tables')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--processes', type=int, default=EXPORT_PROCESSES)
+    for name in VARIANT_ARGS:
+        parser.add_argument(f'--{name}', action='append', choices=VARIANTS[name],
+                            help='only these variants (default: all)')
+    args = parser.parse_args()
+
+    urlqueries = []
+    if args.queries:
+        urlqueries += [line.strip().lstrip('?') for line in args.queries if line.strip()]
+    if args.cached:
+        urlqueries += get_cached_queries()
+    if not urlqueries:
+        parser.error('nothing to do, give a queries file and/or `--cached`')
+    entries, errors = export(urlqueries, args.out, args.processes,
+                             formats=args.format, layouts=args.layout, labels=args.labels)
+    for urlquery, error in errors.items():
+        print(f'failed `{urlquery}`: {error}', file=sys.stderr)
+    sys.exit(1 if errors else 0)
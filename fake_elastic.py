@@ -0,0 +1,223 @@
+"""
+in-process stand-in for the elasticsearch client, serving the calls of this
+app (search with the used query dsl and aggregations, scroll, count,
+get, get_source, index, delete) from fixture documents. used by `loadtest.py` to
+run without any network:
+
+    from fake_elastic import FakeElasticsearch, load_facts
+    load_facts('facts.jsonl')
+"""
+
+
+import json
+import random
+import threading
+from itertools import count
+
+from elasticsearch.exceptions import NotFoundError
+
+from settings import ELASTIC_INDEX
+
+
+INDICES = {}  # index name -> {id: document}, shared by all clients
+SCROLLS = {}
+SCROLL_IDS = count()
+_lock = threading.Lock()
+
+
+def load_facts(fp, index=ELASTIC_INDEX):
+    """load the facts (one json document per line) into `index`"""
+    with open(fp) as f:
+        docs = [json.loads(line) for line in f if line.strip()]
+    INDICES[index] = {str(i): doc for i, doc in enumerate(docs)}
+    return len(docs)
+
+
+def get_field(doc, field):
+    if field.endswith('.keyword'):
+        field = field[:-len('.keyword')]
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return
+        value = value[part]
+    return value
+
+
+def exists(value):
+    if isinstance(value, dict):
+        return any(exists(v) for v in value.values())
+    return value is not None
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def match(doc, query):
+    """evaluate the subset of the query dsl used in this app on `doc`"""
+    if not query:
+        return True
+    (kind, body), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'constant_score':
+        return match(doc, body['filter'])
+    if kind == 'function_score':
+        return match(doc, body.get('query'))
+    if kind == 'bool':
+        must = as_list(body.get('must')) + as_list(body.get('filter'))
+        should = as_list(body.get('should'))
+        if not all(match(doc, q) for q in must):
+            return False
+        if any(match(doc, q) for q in as_list(body.get('must_not'))):
+            return False
+        minimum_should_match = body.get('minimum_should_match', 0 if must else 1)
+        if should and minimum_should_match:
+            return sum(match(doc, q) for q in should) >= minimum_should_match
+        return True
+    if kind == 'term':
+        (field, value), = body.items()
+        if isinstance(value, dict):
+            value = value['value']
+        return str(value) in map(str, as_list(get_field(doc, field)))
+    if kind == 'terms':
+        (field, values), = body.items()
+        return bool(set(map(str, values)) & set(map(str, as_list(get_field(doc, field)))))
+    if kind == 'exists':
+        return exists(get_field(doc, body['field']))
+    if kind == 'prefix':
+        (field, value), = body.items()
+        value_ = get_field(doc, field)
+        return value_ is not None and str(value_).startswith(value)
+    if kind == 'range':
+        (field, bounds), = body.items()
+        value = get_field(doc, field)
+        if value is None:
+            return False
+        value = int(value)
+        ops = {'gte': value.__ge__, 'lte': value.__le__, 'gt': value.__gt__, 'lt': value.__lt__}
+        return all(ops[op](int(bound)) for op, bound in bounds.items())
+    raise NotImplementedError(f'query `{kind}` is not supported by the fake elasticsearch')
+
+
+def aggregate(docs, aggs):
+    result = {}
+    for name, agg in aggs.items():
+        sub_aggs = agg.get('aggs', {})
+        if 'filter' in agg:
+            matched = [d for d in docs if match(d, agg['filter'])]
+            result[name] = {'doc_count': len(matched), **aggregate(matched, sub_aggs)}
+        elif 'terms' in agg:
+            terms = agg['terms']
+            buckets = {}
+            for doc in docs:
+                for value in as_list(get_field(doc, terms['field'])):
+                    buckets.setdefault(value, []).append(doc)
+            (order, direction), = terms.get('order', {'_count': 'desc'}).items()
+            key = (lambda k: str(k)) if order == '_key' else (lambda k: len(buckets[k]))
+            keys = sorted(buckets, key=key, reverse=direction == 'desc')[:terms.get('size', 10)]
+            result[name] = {'buckets': [{'key': k, 'doc_count': len(buckets[k]), **aggregate(buckets[k], sub_aggs)}
+                                        for k in keys]}
+        else:
+            raise NotImplementedError(f'aggregation `{agg}` is not supported by the fake elasticsearch')
+    return result
+
+
+def select_source(doc, fields):
+    if fields is None or fields is True:
+        return doc
+    fields = as_list(fields)
+    return {k: v for k, v in doc.items() if k in fields}
+
+
+class FakeElasticsearch:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _docs(self, index):
+        docs = []
+        for name in as_list(index):
+            docs += list(INDICES.get(name, {}).items())
+        return docs
+
+    def search(self, index=None, body=None, scroll=None, size=None, _source=None, **kwargs):
+        body = {**(body or {}), **{k: v for k, v in kwargs.items() if k in ('query', 'sort', 'aggs', 'from_')}}
+        size = size if size is not None else body.get('size', 10)
+        _source = _source if _source is not None else body.get('_source')
+        query = body.get('query')
+        hits = [(id_, doc) for id_, doc in self._docs(index) if match(doc, query)]
+        docs = [doc for _, doc in hits]
+        if query and 'function_score' in query:
+            random.Random(query['function_score'].get('random_score', {}).get('seed')).shuffle(hits)
+        for sort in reversed(as_list(body.get('sort'))):
+            if isinstance(sort, dict):
+                (field, order), = sort.items()
+                order = order if isinstance(order, str) else order.get('order', 'asc')
+                hits.sort(key=lambda h: str(get_field(h[1], field) or ''), reverse=order == 'desc')
+        hits = [{'_index': as_list(index)[0], '_id': id_, '_source': select_source(doc, _source)}
+                for id_, doc in hits]
+        result = {
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}}
+        }
+        if 'aggs' in body:
+            result['aggregations'] = aggregate(docs, body['aggs'])
+        start = body.get('from_', body.get('from', 0))
+        if scroll:
+            with _lock:
+                scroll_id = str(next(SCROLL_IDS))
+                SCROLLS[scroll_id] = (hits[start + size:], size)
+            result['_scroll_id'] = scroll_id
+        result['hits']['hits'] = hits[start:start + size]
+        return result
+
+    def scroll(self, scroll_id=None, body=None, **kwargs):
+        scroll_id = scroll_id or body['scroll_id']
+        with _lock:
+            hits, size = SCROLLS.pop(scroll_id, ([], 0))
+            SCROLLS[scroll_id] = (hits[size:], size)
+        return {
+            '_scroll_id': scroll_id,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'hits': hits[:size]}
+        }
+
+    def clear_scroll(self, scroll_id=None, **kwargs):
+        with _lock:
+            SCROLLS.pop(scroll_id, None)
+
+    def count(self, index=None, body=None, **kwargs):
+        query = (body or {}).get('query', kwargs.get('query'))
+        return {'count': sum(1 for _, doc in self._docs(index) if match(doc, query))}
+
+    def get(self, index=None, id=None, _source_includes=None, **kwargs):
+        return {'_index': index, '_id': id, 'found': True,
+                '_source': self.get_source(index, id, _source_includes)}
+
+    def get_source(self, index=None, id=None, _source_includes=None, **kwargs):
+        doc = INDICES.get(index, {}).get(id)
+        if doc is None:
+            raise NotFoundError(404, 'not_found', {'_id': id})
+        return select_source(doc, _source_includes)
+
+    def index(self, index=None, id=None, body=None, **kwargs):
+        with _lock:
+            INDICES.setdefault(index, {})[id] = json.loads(json.dumps(body))
+        return {'_index': index, '_id': id, 'result': 'created'}
+
+    def update(self, index=None, id=None, body=None, **kwargs):
+        with _lock:
+            doc = INDICES.get(index, {}).get(id)
+            if doc is None:
+                raise NotFoundError(404, 'document_missing_exception', {'_id': id})
+            doc.update(json.loads(json.dumps(body['doc'])))
+        return {'_index': index, '_id': id, 'result': 'updated'}
+
+    def delete(self, index=None, id=None, **kwargs):
+        with _lock:
+            if INDICES.get(index, {}).pop(id, None) is None:
+                raise NotFoundError(404, 'not_found', {'_id': id})
+        return {'_index': index, '_id': id, 'result': 'deleted'}
@@ -0,0 +1,167 @@
+"""
+replay recorded queries against the app at a target concurrency and report
+latency (p50/p95/p99), throughput, cache hit ratio and memory per query class
+
+    python loadtest.py queries.txt --facts facts.jsonl --concurrency 8 --repeat 3
+    python loadtest.py queries.txt --url http://localhost:5000 --concurrency 8
+
+every line of the queries file is an urlquery, optionally prefixed by a
+query class and a tab (else the class is `<layout>/<format>`). with
+`--facts`, the app runs in this process against `fake_elastic.py` (facts
+and cache index), so no elasticsearch or network is needed. set `SCHEMA_FP`
+and `NAMES_FP` to the schema and names fixtures then.
+"""
+
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import numpy as np
+
+
+def read_queries(fp):
+    queries = []
+    with open(fp) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            query_class, _, urlquery = line.rpartition('\t')
+            urlquery = urlquery.lstrip('?')
+            if not query_class:
+                args = parse_qs(urlquery)
+                query_class = '%s/%s' % (args.get('layout', ['long'])[0], args.get('format', ['csv'])[0])
+            queries.append((query_class, urlquery))
+    return queries
+
+
+def get_rss(pids):
+    """resident memory in bytes of the processes `pids` (linux only)"""
+    rss = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return rss
+
+
+def get_worker_pids():
+    from workers import Workers, HeavyWorkers
+    pids = [os.getpid()]
+    for pool in (Workers, HeavyWorkers):
+        if pool._executor is not None:
+            pids += list(pool._executor._processes or ())
+    return pids
+
+
+def local_client(facts_fp):
+    """request function against the app in this process, with elasticsearch replaced by `fake_elastic`"""
+    import fake_elastic
+    import elastic
+    from cache import Cache
+
+    fake_elastic.load_facts(facts_fp)
+    elastic.Elasticsearch = fake_elastic.FakeElasticsearch
+    Cache.backend.client = fake_elastic.FakeElasticsearch()
+    from app import app
+    client = app.test_client()
+
+    def request(urlquery):
+        response = client.get(f'/?{urlquery}')
+        return response.status_code, response.headers.get('X-Cache'), len(response.data)
+    return request
+
+
+def remote_client(url):
+    import requests
+    session = requests.Session()
+
+    def request(urlquery):
+        response = session.get(f'{url}/?{urlquery}')
+        return response.status_code, response.headers.get('X-Cache'), len(response.content)
+    return request
+
+
+def run(request, queries, concurrency, repeat=1, shuffle=False, memory=True):
+    jobs = queries * repeat
+    if shuffle:
+        random.shuffle(jobs)
+    results = defaultdict(list)
+    lock = threading.Lock()
+
+    def job(query_class, urlquery):
+        started = time.perf_counter()
+        status, cache, size = request(urlquery)
+        latency = time.perf_counter() - started
+        rss = get_rss(get_worker_pids()) if memory else None
+        with lock:
+            results[query_class].append((latency, status, cache, size, rss))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in executor.map(lambda j: job(*j), jobs):
+            pass
+    return results, time.perf_counter() - started
+
+
+def summarize(results, duration):
+    summary = {}
+    for query_class, rows in sorted(results.items()) + [('all', [r for rows in results.values() for r in rows])]:
+        latencies = np.array([r[0] for r in rows]) * 1000
+        caches = [r[2] for r in rows]
+        rss = [r[4] for r in rows if r[4] is not None]
+        summary[query_class] = {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if r[1] >= 400),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 1),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+            'throughput_rps': round(len(rows) / duration, 1),
+            'hit_ratio': round(caches.count('hit') / len(rows), 3),
+            'base_ratio': round(caches.count('base') / len(rows), 3),
+            'max_rss_mb': round(max(rss) / 2 ** 20, 1) if rss else None
+        }
+    return summary
+
+
+def print_summary(summary):
+    columns = ['requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'hit_ratio', 'base_ratio',
+               'max_rss_mb']
+    width = max(len(c) for c in summary)
+    print(' '.join(['class'.ljust(width)] + [c.rjust(14) for c in columns]))
+    for query_class, row in summary.items():
+        print(' '.join([query_class.ljust(width)] + [str(row[c]).rjust(14) for c in columns]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay queries against the tabular api')
+    parser.add_argument('queries', help='file with one urlquery per line, optionally `class<TAB>urlquery`')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--facts', help='run the app in-process against a fake elasticsearch with these facts')
+    target.add_argument('--url', help='base url of a running app')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=1, help='replay the queries this often')
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--json', action='store_true', help='print the summary as json')
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries)
+    if not queries:
+        parser.error(f'no queries in `{args.queries}`')
+    request = local_client(args.facts) if args.facts else remote_client(args.url.rstrip('/'))
+    results, duration = run(request, queries, args.concurrency, args.repeat, args.shuffle,
+                            memory=bool(args.facts))
+    summary = summarize(results, duration)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
@@ -3,7 +3,7 @@ import re
 from hashlib import sha1
 from urllib.parse import parse_qs
 
-from schema import Schema
+from schema import Schema, Regions
 from util import cached_property, tree
 from exceptions import ValidationError
 
@@ -90,6 +90,7 @@ class DataArgument(Argument):
 
 
 NUM_RE = r'^\d+'
+PAGING_ARGS = ('limit', 'offset')
 
 
 class Query:
@@ -109,6 +110,8 @@ class Query:
     format = Argument('format', 'csv', choices=['tsv', 'json'])
     delimiter = Argument('delimiter', ',', choices=[';'])
     sort = Argument('sort', 'time', choices=['region', 'value', 'measure'])  # data sorting
+    limit = Argument('limit', None, regex=[r'^\d+$'], multi=False)  # paging, not part of the table definition
+    offset = Argument('offset', None, regex=[r'^\d+$'], multi=False)
     # not implemented:
     # order = Argument('order', 'time,region,value,keys',
     #                  choices=['time', 'region', 'value', 'keys', 'meta'])  # column order
@@ -136,6 +139,10 @@ class Query:
     def cleaned_data(self):
         return dict(sorted(self.clean().items()))
 
+    @cached_property
+    def table_definition(self):
+        return {k: v for k, v in self.cleaned_data.items() if k not in PAGING_ARGS}
+
     @cached_property
     def data_definition(self):
         return {k: v for k, v in self.cleaned_data.items()
@@ -144,13 +151,55 @@ class Query:
     @cached_property
     def key(self):
         """unique identifier for exactly this table with all given specs about format etc"""
-        return sha1(json.dumps(self.cleaned_data).encode()).hexdigest()
+        return sha1(json.dumps(self.table_definition).encode()).hexdigest()
 
     @cached_property
     def data_key(self):
         """unique identifier for the exact data used for this table regardless of format/transform options"""
         return sha1(json.dumps(self.data_definition).encode()).hexdigest()
 
+    @cached_property
+    def region_ids(self):
+        """exact set of selected region ids if it can be derived from the region index, else `None`"""
+        region, parent = self.cleaned_data['region'], self.cleaned_data['parent']
+        if region != 'all':
+            regions = set([region] if isinstance(region, str) else region)
+            if parent:
+                regions = set(r for r in regions if r.startswith(parent))
+            return regions
+        if parent:
+            return Regions.get_regions(parent, self.cleaned_data['level'])
+
+    @cached_property
+    def superset_data_definition(self):
+        """
+        data definition of a base table (all regions of one level) that contains
+        this one, so that it can be filtered locally via `region_ids`
+        """
+        if self.cleaned_data['time'] == 'latest':  # the latest year depends on the selected regions
+            return
+        if self.region_ids is None:
+            return
+        levels = set(Regions.levels[r] for r in self.region_ids)
+        if len(levels) != 1 or None in levels:
+            return
+        definition = {**self.data_definition, 'region': 'all', 'level': str(levels.pop()), 'parent': None}
+        if definition != self.data_definition:
+            return definition
+
+    @cached_property
+    def superset_data_key(self):
+        if self.superset_data_definition:
+            return sha1(json.dumps(self.superset_data_definition).encode()).hexdigest()
+
+    @cached_property
+    def paging(self):
+        """`(offset, limit)` row window if requested via `?offset=` / `?limit=`, else `None`"""
+        offset, limit = self.cleaned_data['offset'], self.cleaned_data['limit']
+        if offset is None and limit is None:
+            return
+        return int(offset or 0), None if limit is None else int(limit)
+
     @cached_property
     def arguments(self):
         return [(key, arg) for key, arg in self.__class__.__dict__.items() if isinstance(arg, Argument)]
@@ -0,0 +1,156 @@
+"""
+refresh the cache after single GENESIS cubes were updated, instead of
+throwing away the whole cache
+
+    python refresh.py 12411BJ001 12411BJ002
+    python refresh.py --invalidate 12411BJ001
+
+affected entries are found via their `cubes`. the cached base tables get the
+facts of the updated cubes replaced (only these facts are fetched from
+elasticsearch) and all concrete entries depending on them are re-rendered.
+base tables without the cube of every fact (cached before it was kept) and
+`time=latest` tables (whose latest year may have changed) are rebuilt
+completely.
+"""
+
+
+import argparse
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from elasticsearch.helpers import scan
+
+from cache import Cache
+from elastic import ElasticQuery
+from exceptions import ValidationError
+from query import Query
+from settings import WARMUP_CONCURRENCY
+from table import Table, encode_orderings, load_base
+from workers import process_table
+
+
+def get_affected(cubes):
+    """ids and sources (without contents) of all cache entries built from one of `cubes`"""
+    for hit in scan(Cache.backend.client, index=Cache.backend.index, _source=['kind', 'urlquery'],
+                    query={'query': {'terms': {'cubes': list(cubes)}}}):
+        yield hit['_id'], hit['_source']
+
+
+def invalidate(cubes):
+    ids = [id_ for id_, _ in get_affected(cubes)]
+    for id_ in ids:
+        Cache.delete(id_)
+    return len(ids)
+
+
+def concat_categoricals(dfs):
+    """concat long frames and restore their categorical columns (with sorted categories like `build_df`)"""
+    categorical = [c for c in dfs[0].columns if isinstance(dfs[0][c].dtype, pd.CategoricalDtype)]
+    df = pd.concat([df.astype({c: object for c in categorical if c in df}) for df in dfs])
+    return df.astype({c: pd.CategoricalDtype(sorted(df[c].dropna().unique())) for c in categorical})
+
+
+def splice(base_data, query, cubes):
+    """
+    the long frame of `base_data` with the facts of `cubes` replaced by the
+    current ones from elasticsearch, `None` if it can't be spliced
+    """
+    df = load_base(base_data)
+    if 'cube' not in df:
+        return
+    df = df[~df['cube'].isin(cubes)]
+    table = Table(ElasticQuery(query.cleaned_data, cubes=cubes).facts, query)
+    if not table._is_empty:
+        table.clean_columns()
+        table.make_long()
+        update = table._long_df
+        update.index = update.index + (df.index.max() + 1 if len(df) else 0)
+        df = concat_categoricals([df, update])
+    # renumber the facts like in a freshly built table
+    df.index = np.unique(df.index, return_inverse=True)[1]
+    return df
+
+
+def refresh_group(queries, cubes):
+    """refresh the base table of `queries` and re-render them, returns the number of stored entries"""
+    query = queries[0]
+    base_data = Cache.get(query.data_key)
+    df = None
+    if base_data and query.cleaned_data['time'] != 'latest':
+        df = splice(base_data, query, cubes)
+    orderings = {}  # the rows of the base table are sorted once per `sort` and `labels`
+    stored = 0
+    if df is None:
+        # rebuild from all facts
+        table = Table(ElasticQuery(query.cleaned_data).facts, query, orderings=orderings)
+        concrete, base_data, _ = process_table(table)
+        Cache.set(query.key, concrete)
+        stored += 1
+        queries = queries[1:]
+    else:
+        base_data = Table(df, query, True).serialize_base()
+    Cache.set(query.data_key, base_data)
+    stored += 1
+    known = set(orderings)
+    for q in queries:
+        concrete, _, _ = process_table(Table.from_base(base_data, q, orderings=orderings), with_base=False)
+        Cache.set(q.key, concrete)
+        stored += 1
+    if set(orderings) - known:
+        # keep the orderings sorted for the re-rendered tables with the base table
+        Cache.update(query.data_key, {'orderings': encode_orderings(orderings, base_data['created'])})
+    return stored
+
+
+def refresh(cubes, concurrency=WARMUP_CONCURRENCY):
+    """
+    refresh all cache entries built from one of `cubes`: concrete entries are
+    re-rendered (grouped by their base table), other base tables are dropped
+    """
+    groups = defaultdict(dict)
+    stale = []
+    for id_, source in get_affected(cubes):
+        if source['kind'] != 'concrete':
+            stale.append(id_)
+            continue
+        try:
+            query = Query(source['urlquery'])
+            groups[query.data_key][query.key] = query
+        except ValidationError:  # the schema changed
+            Cache.delete(id_)
+    for id_ in stale:
+        if id_ not in groups:
+            Cache.delete(id_)
+
+    refreshed = failed = 0
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(refresh_group, list(queries.values()), cubes): key
+                   for key, queries in groups.items()}
+        for future in as_completed(futures):
+            try:
+                refreshed += future.result()
+            except Exception as e:
+                # don't keep serving stale data
+                failed += 1
+                print(f'failed refreshing {futures[future]}: {e!r}', file=sys.stderr)
+                for key in (futures[future], *groups[futures[future]]):
+                    Cache.delete(key)
+    return refreshed, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='refresh cached tables of updated cubes')
+    parser.add_argument('cubes', nargs='+')
+    parser.add_argument('--invalidate', action='store_true', help='only delete the affected entries')
+    parser.add_argument('--concurrency', type=int, default=WARMUP_CONCURRENCY)
+    args = parser.parse_args()
+
+    if args.invalidate:
+        print(f'{invalidate(args.cubes)} entries deleted', file=sys.stderr)
+        sys.exit(0)
+    refreshed, failed = refresh(args.cubes, args.concurrency)
+    print(f'{refreshed} entries refreshed, {failed} base tables failed', file=sys.stderr)
+    sys.exit(1 if failed else 0)
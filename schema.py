@@ -1,5 +1,6 @@
 import json
 import requests
+from collections import defaultdict
 
 from settings import STORAGE_NAME, SCHEMA_URL, NAMES_URL, SCHEMA_FP, NAMES_FP
 from exceptions import ValidationError
@@ -16,6 +17,56 @@ else:
     NAMES = requests.get(NAMES_URL).json()
 
 
+# region id length -> region level (AGS: Bundesland, Regierungsbezirk, Kreis, Gemeinde)
+REGION_ID_LEVELS = {2: 1, 3: 2, 5: 3, 8: 4}
+ROOT_REGION = 'DG'
+
+
+class RegionIndex:
+    """
+    region hierarchy built once from `NAMES`: level, parent and children of every region id
+    """
+    def __init__(self, names):
+        self.levels = {}
+        self.parents = {}
+        self.children = defaultdict(set)
+        for region in names:
+            self.levels[region] = 0 if region == ROOT_REGION else REGION_ID_LEVELS.get(len(region))
+        for region in names:
+            if region == ROOT_REGION:
+                continue
+            # the parent is the longest known proper prefix of the region id
+            parent = next((region[:i] for i in range(len(region) - 1, 0, -1) if region[:i] in self.levels), ROOT_REGION)
+            self.parents[region] = parent
+            self.children[parent].add(region)
+
+    def __contains__(self, region):
+        return region in self.levels
+
+    def get_descendants(self, region):
+        children = self.children.get(region, ())
+        yield from children
+        for child in children:
+            yield from self.get_descendants(child)
+
+    def get_regions(self, parent, level='all'):
+        """
+        exact set of region ids starting with `parent` (the parent itself and
+        all regions below it, like a prefix query) for the given `level`
+        (`'all'`, a single level or a list of levels) or `None` if some of them
+        have an unknown level and therefore can't be selected exactly
+        """
+        levels = None if level == 'all' else set(int(l) for l in ([level] if isinstance(level, str) else level))
+        regions = set()
+        for region in (parent, *self.get_descendants(parent)):
+            region_level = self.levels[region]
+            if region_level is None:
+                return
+            if levels is None or region_level in levels:
+                regions.add(region)
+        return regions
+
+
 class Mixin:
     _child_class = None
     _child_accessor = None
@@ -149,17 +200,19 @@ class Schema(Mixin):
     def validate_parent(self, parent):
         if parent is None:
             return True
-        if parent not in NAMES.keys():
+        if parent not in Regions:
             raise ValidationError(f'`{parent}` is not a valid parent region key.')
         return True
 
     def validate_region(self, region):
         if region == 'all':
             return True
-        regions = region.split(',')
-        if set(regions) - set(NAMES.keys()):
-            raise ValidationError(f'`{region}` is not a valid region key.')
+        regions = region.split(',') if isinstance(region, str) else region
+        for r in regions:
+            if r not in Regions:
+                raise ValidationError(f'`{r}` is not a valid region key.')
         return True
 
 
 Schema = Schema(SCHEMA)
+Regions = RegionIndex(NAMES)
@@ -5,6 +5,8 @@ ELASTIC_HOST = os.getenv('ELASTIC_HOST', 'http://localhost:9200')
 ELASTIC_INDEX = os.getenv('ELASTIC_INDEX', 'genesapi')
 ELASTIC_CACHE_INDEX = os.getenv('ELASTIC_CACHE_INDEX', 'genesapi-tabular-cache--%s' % ELASTIC_INDEX)
 ELASTIC_AUTH = os.getenv('ELASTIC_AUTH')
+LATEST_YEAR_CACHE_TTL = int(os.getenv('LATEST_YEAR_CACHE_TTL', 3600))  # seconds
+REGION_TERMS_MAX = int(os.getenv('REGION_TERMS_MAX', 1024))  # max region ids to query for instead of a prefix
 STORAGE_NAME = os.getenv('STORAGE_NAME', 'Regionalstatistik')
 DOCS_FILE = './README.md'
 SCHEMA_URL = 'https://data.genesapi.org/regionalstatistik/schema.json'
@@ -12,3 +14,26 @@ SCHEMA_FP = os.getenv('SCHEMA_FP')
 NAMES_URL = 'https://data.genesapi.org/regionalstatistik/names.json'
 NAMES_FP = os.getenv('NAMES_FP')
 GENESAPI_TABULAR_STATIC = 'https://static.tabular.genesapi.org'
+EXAMPLES_CACHE_TTL = int(os.getenv('EXAMPLES_CACHE_TTL', 60))  # seconds
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))  # process pool for large tables, 0: build in-process
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 2 * WORKER_PROCESSES))  # more pending large tables: 503
+WORKER_MIN_ROWS = int(os.getenv('WORKER_MIN_ROWS', 100000))  # smaller tables are always built in-process
+HEAVY_WORKER_PROCESSES = int(os.getenv('HEAVY_WORKER_PROCESSES', 0))  # process pool for heavy queries, 0: in-process
+HEAVY_WORKER_QUEUE_SIZE = int(os.getenv('HEAVY_WORKER_QUEUE_SIZE', max(1, HEAVY_WORKER_PROCESSES)))
+QUERY_MAX_ROWS = int(os.getenv('QUERY_MAX_ROWS', 5000000))  # estimated rows, larger queries are rejected
+QUERY_HEAVY_ROWS = int(os.getenv('QUERY_HEAVY_ROWS', 500000))  # estimated rows, larger queries use the heavy lane
+QUERY_COUNT_MIN_ROWS = int(os.getenv('QUERY_COUNT_MIN_ROWS', 10000))  # schema estimate, only larger are counted in ES
+ESTIMATE_YEARS = int(os.getenv('ESTIMATE_YEARS', 30))  # assumed number of years for open time ranges
+ESTIMATE_ROW_BYTES = int(os.getenv('ESTIMATE_ROW_BYTES', 60))  # rendered bytes per row (without dimensions)
+WARMUP_CONCURRENCY = int(os.getenv('WARMUP_CONCURRENCY', 4))  # parallel base tables of the warm-up job
+EXPORT_PROCESSES = int(os.getenv('EXPORT_PROCESSES', os.cpu_count() or 1))  # worker processes of the static export
+MEASURE_FILTER_CACHE_SIZE = int(os.getenv('MEASURE_FILTER_CACHE_SIZE', 4096))  # compiled measure filters in memory
+DISK_CACHE_DIR = os.getenv('DISK_CACHE_DIR')  # host-local cache tier in front of elasticsearch, unset: disabled
+DISK_CACHE_MAX_BYTES = int(os.getenv('DISK_CACHE_MAX_BYTES', 2 ** 30))  # least recently used entries are evicted
+DISK_CACHE_MAX_AGE = int(os.getenv('DISK_CACHE_MAX_AGE', 3600))  # seconds stored locally, then read from elasticsearch
+TABLE_MEMORY_LIMIT = int(os.getenv('TABLE_MEMORY_LIMIT', 2 ** 30))  # bytes per table, larger wide ones go in blocks
+CACHE_MAX_AGE = int(os.getenv('CACHE_MAX_AGE', 86400))  # seconds, older cached tables are rebuilt in the background
+CACHE_MAX_STALE = int(os.getenv('CACHE_MAX_STALE', 7 * 86400))  # seconds after `CACHE_MAX_AGE` a table is still served
+REVALIDATE_THREADS = int(os.getenv('REVALIDATE_THREADS', 2))  # background rebuilds of stale tables per process
+ELASTIC_TIMEOUT = int(os.getenv('ELASTIC_TIMEOUT', 10))  # seconds per elasticsearch request (search, scroll, count)
+ELASTIC_SCAN_DEADLINE = int(os.getenv('ELASTIC_SCAN_DEADLINE', 60))  # seconds for all facts of a query
@@ -1,12 +1,24 @@
 import base64
+import csv
+import json
+import tempfile
+from array import array
+from io import StringIO
+from itertools import islice
+
+import numpy as np
 import pandas as pd
 import pickle
 
 from schema import NAMES
+from settings import TABLE_MEMORY_LIMIT
 from util import cached_property
 
 
 META_FIELDS = ['region_id', 'statistic']
+PREVIEW_ROWS = 11
+# rough peak memory of the wide layout transform per long row (tuple index, unstacked frames)
+WIDE_BYTES_PER_ROW = 1000
 FIELD_LABELS = {
     'region_id': 'ID_Region',
     'region_name': 'Region',
@@ -24,36 +36,211 @@ dtypes = {
 }
 
 
-def typed(df):
-    for col, t in dtypes.items():
-        if col in df:
-            df[col] = df[col].map(t)
-    return df
+def build_df(facts, fields, measures, categories):
+    """
+    consume raw fact documents (`_source` of the elasticsearch hits) directly
+    into typed columns instead of letting pandas infer them from a list of dicts:
+    `fields` as (typed) objects, `measures` unwrapped into float64, `categories` as categoricals.
+    fields missing in every fact are left out, like `pd.DataFrame(facts)` would do.
+    """
+    nan = float('nan')
+    objects = {f: [] for f in fields}
+    values = {m: array('d') for m in measures}
+    codes = {c: array('q') for c in categories}
+    lookups = {c: {} for c in categories}
+    # bind the appenders once, this loop runs for every single fact
+    object_columns = [(f, objects[f].append, dtypes.get(f)) for f in fields]
+    value_columns = [(m, values[m].append) for m in measures]
+    code_columns = [(c, codes[c].append, lookups[c]) for c in categories]
+    for fact in facts:
+        get = fact.get
+        for field, append, type_ in object_columns:
+            value = get(field)
+            append(value if value is None or type_ is None else type_(value))
+        for measure, append in value_columns:
+            value = get(measure)
+            if value.__class__ is dict:
+                value = value.get('value')
+            append(nan if value is None else value)
+        for category, append, lookup in code_columns:
+            value = get(category)
+            if value is None:
+                append(-1)
+            else:
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(lookup)
+                append(code)
+
+    columns = {}
+    for field, column in objects.items():
+        if any(v is not None for v in column):
+            columns[field] = np.array(column, dtype=object)
+    for measure, column in values.items():
+        column = np.frombuffer(column, dtype='float64')
+        if not np.isnan(column).all():
+            columns[measure] = column
+    for category, column in codes.items():
+        if lookups[category]:
+            # sorted categories so that sorting by them equals sorting by their values
+            labels = [str(v) for v in lookups[category]]
+            categorical = pd.Categorical.from_codes(np.frombuffer(column, dtype='int64'), labels)
+            columns[category] = categorical.reorder_categories(sorted(labels))
+    return pd.DataFrame(columns)
+
+
+def get_row_offsets(content):
+    """byte offsets of every line start in the utf-8 encoded `content`, ending with its total length"""
+    data = np.frombuffer(content.encode() if isinstance(content, str) else content, dtype=np.uint8)
+    offsets = np.flatnonzero(data == ord('\n')) + 1
+    if not len(offsets) or offsets[-1] != len(data):
+        offsets = np.append(offsets, len(data))
+    return np.concatenate(([0], offsets)).astype(np.uint64)
+
+
+def encode_offsets(offsets):
+    return base64.b64encode(offsets.tobytes()).decode()
+
+
+def decode_offsets(data):
+    return np.frombuffer(base64.b64decode(data), dtype=np.uint64)
+
+
+def get_record_offsets(content):
+    """
+    character offsets of every record of a rendered json `content` (`orient='table'`,
+    ascii only, so they are byte offsets too), ending with the end of the last one + 1
+    """
+    decoder = json.JSONDecoder()
+    position = content.index('"data":[') + len('"data":[')
+    offsets = []
+    while content[position] != ']':
+        offsets.append(position)
+        _, position = decoder.raw_decode(content, position)
+        if content[position] == ',':
+            position += 1
+    offsets.append(position + 1)
+    return np.array(offsets, dtype=np.uint64)
+
+
+def slice_records(content, record_offsets, offset=0, limit=None):
+    """rendered json `content` with only the records `[offset:offset + limit]` as utf-8 bytes"""
+    if isinstance(content, str):
+        content = content.encode()
+    count = len(record_offsets) - 1
+    start = min(offset, count)
+    end = count if limit is None else min(start + limit, count)
+    data_end = int(record_offsets[-1]) - 1  # the closing `]`
+    data_start = int(record_offsets[0]) if count else data_end
+    records = content[int(record_offsets[start]):int(record_offsets[end]) - 1] if start < end else b''
+    return content[:data_start] + records + content[data_end:]
+
+
+def slice_entry(entry, offset=0, limit=None):
+    """page of the content of a cached concrete entry, `None` if it was cached without offsets"""
+    if 'row_offsets' in entry:
+        return slice_rows(entry['content'], decode_offsets(entry['row_offsets']), offset, limit)
+    if 'record_offsets' in entry:
+        return slice_records(entry['content'], decode_offsets(entry['record_offsets']), offset, limit)
+
+
+def load_base(base_data):
+    """long frame of a cached base table"""
+    return pickle.loads(base64.b64decode(base_data['blob']))
+
+
+def encode_orderings(orderings, created=None):
+    """
+    `orderings` of the rows of a base table for its cache entry, `created`
+    of the entry if they are added to it later (see `load_orderings`)
+    """
+    orderings = {k: o.astype(np.int32) if len(o) < 2 ** 31 else o for k, o in orderings.items()}
+    return base64.b64encode(pickle.dumps((created, orderings))).decode()
+
+
+def load_orderings(base_data):
+    """
+    row orderings of a cached base table, none if they were added to an
+    older version of the entry (the entry was replaced meanwhile)
+    """
+    if not base_data.get('orderings'):
+        return {}
+    created, orderings = pickle.loads(base64.b64decode(base_data['orderings']))
+    if created not in (None, base_data.get('created')):
+        return {}
+    return orderings
+
+
+def restrict_ordering(ordering, mask):
+    """`ordering` of all rows as ordering of the rows selected by the boolean `mask`"""
+    positions = np.cumsum(mask) - 1
+    return positions[ordering[mask[ordering]]]
+
+
+def slice_rows(content, row_offsets, offset=0, limit=None):
+    """header + rows `[offset:offset + limit]` of rendered csv/tsv `content` as utf-8 bytes"""
+    if isinstance(content, str):
+        content = content.encode()
+    last = len(row_offsets) - 1
+    start = min(offset + 1, last)
+    end = last if limit is None else min(start + limit, last)
+    return content[:row_offsets[1]] + content[row_offsets[start]:row_offsets[end]]
+
+
+def get_preview(content, delimiter, schema, row_offsets=None):
+    """title, subtitle, header and the first rows of a rendered csv table, shown on `/examples/`"""
+    if row_offsets is None:
+        lines = list(islice(StringIO(content), PREVIEW_ROWS + 1))
+    else:
+        lines = slice_rows(content, row_offsets, 0, PREVIEW_ROWS).decode().splitlines()
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    return {
+        'title': ' / '.join(s.title_de for s in schema),
+        'subtitle': ', '.join(m.title_de for s in schema for m in s),
+        'header': rows[0] if rows else [],
+        'rows': rows[1:]
+    }
 
 
 class Table:
-    def __init__(self, facts, query, from_base=False, cubes=[]):
+    def __init__(self, facts, query, from_base=False, cubes=[], orderings=None):
+        self.query = query
+        self.measure_keys = [m.key for s in query.schema for m in s]
+        self.dimension_keys = [d.key for s in query.schema for m in s for d in m]
+        self.schema = query.schema
         if from_base:
+            self._df = self._long_df = facts
+        elif isinstance(facts, pd.DataFrame):  # already built via `build_df`
             self._df = facts
-            self._from_base = True
         else:
-            self._df = typed(pd.DataFrame(facts))
-            self._from_base = False
+            self._df = build_df(facts, ['region_id', query.cleaned_data['dformat']], self.measure_keys,
+                                ['statistic', 'cube'] + sorted(set(self.dimension_keys)))
         self._from_base = from_base
+        # row orderings of the long frame per `(sort, labels)`, filled when sorting and
+        # shared by the tables rendered from the same base table
+        self._orderings = {} if orderings is None else orderings
         self._is_empty = not len(self._df)
-        self.query = query
-        self.measure_keys = [m.key for s in query.schema for m in s]
-        self.dimension_keys = [d.key for s in query.schema for m in s for d in m]
-        self.schema = query.schema
         if not self._is_empty:
             self.cubes = cubes or list(self._df['cube'].unique())
         for k, v in query.cleaned_data.items():
             setattr(self, k, v)
 
     @classmethod
-    def from_base(cls, base_data, query):
-        df = pickle.loads(base64.b64decode(base_data['blob']))
-        return cls(df, query, True, cubes=base_data['cubes'])
+    def from_base(cls, base_data, query, regions=None, orderings=None):
+        """
+        table from a cached base table, optionally filtered locally to the
+        given region ids (if the base table is a superset of the query).
+        `orderings` (see `load_orderings`) are shared with the other tables
+        from this base table, a filtered table gets a restricted copy.
+        """
+        df = load_base(base_data)
+        if regions is not None:
+            mask = df['region_id'].isin(regions).values
+            df = df[mask]
+            # renumber the facts like in a table built from just these regions
+            df.index = np.unique(df.index, return_inverse=True)[1]
+            orderings = {k: restrict_ordering(o, mask) for k, o in (orderings or {}).items()}
+        return cls(df, query, True, cubes=base_data['cubes'], orderings=orderings)
 
     @cached_property
     def df(self):
@@ -75,19 +262,92 @@ class Table:
         return 'text/plain'
 
     def rendered(self):
+        if self.chunked:
+            return self.chunked_csv
         return self.formats[self.format]
 
-    def to_json(self):
-        return self.df.to_json(orient='table')
+    @cached_property
+    def chunked_csv(self):
+        return self.to_csv_chunked(delimiter='\t' if self.format == 'tsv' else None)
+
+    @cached_property
+    def chunked(self):
+        """if this wide csv/tsv table is too large to be transformed in memory at once"""
+        return (not self._is_empty and self.layout != 'long' and self.format != 'json'
+                and len(self._df) * WIDE_BYTES_PER_ROW > TABLE_MEMORY_LIMIT)
+
+    def paginated(self, offset=0, limit=None):
+        if self.format == 'json':
+            return self.to_json(self.df.iloc[offset:None if limit is None else offset + limit])
+        content = self.rendered()
+        return slice_rows(content, get_row_offsets(content), offset, limit)
+
+    def to_json(self, df=None):
+        return (self.df if df is None else df).to_json(orient='table')
 
     def to_csv(self, delimiter=None):
         return self.df.fillna('').to_csv(index=not self.layout == 'long', sep=delimiter or self.delimiter)
 
+    def to_csv_chunked(self, delimiter=None):
+        """
+        wide layout rendered in blocks of its rows (regions for `layout=region`,
+        years for `layout=time`), each one small enough for `TABLE_MEMORY_LIMIT`.
+        the processed blocks are spilled to a temporary file, then written with
+        the columns and column types of the whole table, so that the output is
+        the same as from `to_csv`. only the frames are bounded, the content is
+        held in memory once to be cached.
+        """
+        if not hasattr(self, '_long_df'):
+            self.clean_columns()
+            self.make_long()
+        df = self._long_df
+        key = 'region_id' if self.layout == 'region' else self.dformat
+        counts = df[key].astype(object).value_counts().sort_index()
+        rows = max(TABLE_MEMORY_LIMIT // WIDE_BYTES_PER_ROW, 1)
+
+        blocks = []
+        block, block_rows = [], 0
+        for value, count in counts.items():
+            if block and block_rows + count > rows:
+                blocks.append(block)
+                block, block_rows = [], 0
+            block.append(value)
+            block_rows += count
+        blocks.append(block)
+
+        # first pass: process every block, collect columns and types
+        dtypes = {}
+        with tempfile.TemporaryFile() as spill:
+            for block in blocks:
+                table = Table(df[df[key].isin(block)], self.query, True, cubes=self.cubes)
+                table.process()
+                for column, dtype in table._df.dtypes.items():
+                    dtypes.setdefault(column, []).append(dtype)
+                pickle.dump(table._df, spill)
+
+            # the types of the whole column, like inferred by `clean_types` on the whole table
+            for column, types in dtypes.items():
+                if any(t == object for t in types):
+                    dtypes[column] = object
+                elif len(types) < len(blocks) or any(t.kind == 'f' for t in types):
+                    dtypes[column] = float
+                else:
+                    dtypes[column] = types[0]
+            columns = self.get_column_order(dtypes.keys())
+
+            # second pass: write the blocks with all columns to a file, read once into the (cached) content
+            with tempfile.TemporaryFile('w+', newline='') as out:
+                spill.seek(0)
+                for i in range(len(blocks)):
+                    block = pickle.load(spill).reindex(columns=columns).astype({c: dtypes[c] for c in columns})
+                    block.fillna('').to_csv(out, header=i == 0, sep=delimiter or self.delimiter)
+                out.seek(0)
+                return out.read()
+
     def process(self):
         if self._is_empty:
             return
         if not self._from_base:
-            self.clean_values()
             self.clean_columns()
             self.make_long()
         self.transform()
@@ -105,7 +365,9 @@ class Table:
             df_s_ = []
             for measure in statistic:
                 dimensions = list(set(d.key for d in measure) & set(df_s.columns))  # FIXME validate schema / levels
-                df_m = df_s[['region_id', self.dformat, 'statistic', measure.key] + dimensions]
+                # the cube of every fact is kept in the base table to refresh it per cube (see `refresh.py`)
+                cube = ['cube'] if 'cube' in df_s else []
+                df_m = df_s[['region_id', self.dformat, 'statistic'] + cube + [measure.key] + dimensions]
                 df_m = df_m.dropna(subset=[measure.key])
                 df_m = df_m.rename(columns={**{measure.key: 'value'},
                                             **{dimension: (statistic.key, measure.key, dimension)
@@ -116,9 +378,11 @@ class Table:
         self._df = self._long_df = pd.concat(dfs).dropna(axis=1, how='all')
 
     def transform(self):
+        self._df = self._df.drop(columns='cube', errors='ignore')
         if self.layout == 'long':
-            if not self._from_base:
-                self._df['measure'] = self._df['measure'].map(lambda x: x[1])
+            # a new frame, the long one is kept as base table for all layouts
+            # (entries cached before already have the measure keys only)
+            self._df = self._df.assign(measure=self._df['measure'].map(lambda x: x[1] if isinstance(x, tuple) else x))
             return  # already transformed via `self.make_long`
         dfs = []
         for measure in self._df['measure'].unique():
@@ -129,21 +393,17 @@ class Table:
                 index_cols = [self.dformat, 'region_id', 'measure'] + index_cols
             if self.layout == 'region':
                 index_cols = ['region_id', self.dformat, 'measure'] + index_cols
-            df.sort_values(index_cols, inplace=True)
-            df.index = [df[c].map(lambda x: (c, x)) for c in index_cols]
+            # no need to sort, `unstack` orders by the (sorted) index levels
+            df.index = [df[c].astype(object).map(lambda x: (c, x)) for c in index_cols]
             df = df['value']
             for i in range(len(index_cols) - 1):
                 df = df.unstack()
             dfs.append(df)
         self._df = pd.concat(dfs, axis=1).dropna(axis=1, how='all')
 
-    def clean_values(self):
-        for measure in self.measure_keys:
-            if measure in self._df.columns:
-                self._df[measure] = self._df[measure].map(lambda x: x['value'] if isinstance(x, dict) else x)
-
     def clean_columns(self):
-        columns = [c for c in set(self.meta_fields + self.measure_keys + self.dimension_keys) if c in self._df]
+        keep = set(self.meta_fields + ['cube'] + self.measure_keys + self.dimension_keys)
+        columns = [c for c in keep if c in self._df]
         self._df = self._df[columns]
 
     def labelize(self):
@@ -235,6 +495,22 @@ class Table:
         self._df.columns = self._df.columns.map(get_column_name)
 
     def sort_values(self):
+        if self.layout != 'long':
+            # one row per region or year
+            self._df.sort_index(inplace=True)
+            return
+        # the long frame has the rows of the base table, so the ordering applies to all its tables
+        ordering = self._orderings.get((self.sort, self.labels))
+        if ordering is not None:
+            self._df = self._df.iloc[ordering]
+            return
+        index = self._df.index
+        self._df.index = pd.RangeIndex(len(self._df))
+        self._df.sort_values(self.get_sort_columns(self._df.columns), inplace=True)
+        ordering = self._orderings[self.sort, self.labels] = self._df.index.values
+        self._df.index = index[ordering]
+
+    def get_sort_columns(self, columns):
         # ?sort=
         main_col = self._labels({
             'time': self.dformat,
@@ -250,21 +526,20 @@ class Table:
             'time': [self.dformat, 'region_id', 'measure']
         }[self.layout])
 
-        columns = [c for c in main_col + list(set(column_order) - set(main_col)) if c in self._df.columns]
-        other_columns = sorted(set(self._df.columns) - set(columns))
-        self._df.sort_values(columns + other_columns, inplace=True)
-        if self._df.index.name in column_order + main_col:
-            self._df.sort_index(inplace=True)
+        first_columns = [c for c in main_col + [c for c in column_order if c not in main_col] if c in columns]
+        return first_columns + sorted(set(columns) - set(first_columns))
 
     def order_columns(self):
+        self._df = self._df[self.get_column_order(self._df.columns)]
+
+    def get_column_order(self, columns):
         layouts = {
             'long': ['region_id', 'region_name', self.dformat, 'measure', 'value'],
             'region': ['region_id', 'region_name', self.dformat, 'measure'],
             'time': [self.dformat, 'region_id', 'region_name', 'measure']
         }
-        columns = [c for c in self._labels(*layouts[self.layout]) if c in self._df.columns]
-        other_columns = sorted(set(self._df.columns) - set(columns))
-        self._df = self._df[columns + other_columns]
+        first_columns = [c for c in self._labels(*layouts[self.layout]) if c in columns]
+        return first_columns + sorted(set(columns) - set(first_columns))
 
     def clean_types(self):
         def clean(value):
@@ -283,18 +558,30 @@ class Table:
         return META_FIELDS + [self.dformat]
 
     def serialize(self):
-        return {
+        data = {
             'content': self.rendered(),
             'mimetype': self.mimetype,
             'cubes': self.cubes,
-            'definition': self.query.cleaned_data,
+            'definition': self.query.table_definition,
             'urlquery': self.query.urlquery,
             'kind': 'concrete'
         }
+        if self.format != 'json':
+            # allows serving `?limit=` / `?offset=` pages directly from the cached content
+            row_offsets = get_row_offsets(data['content'])
+            data['row_offsets'] = encode_offsets(row_offsets)
+            if self.format == 'csv':
+                data['preview'] = get_preview(data['content'], self.delimiter, self.schema, row_offsets)
+        else:
+            # and pages of the json records
+            data['record_offsets'] = encode_offsets(get_record_offsets(data['content']))
+        return data
 
     def serialize_base(self):
         return {
             'blob': base64.b64encode(pickle.dumps(self._long_df)).decode(),
+            # the row orderings computed so far, stored with the blob in the same document
+            'orderings': encode_orderings(self._orderings),
             'cubes': self.cubes,
             'definition': self.query.data_definition,
             'kind': 'base'
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the app modules are top-level modules of the repository, the schema is read at import
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+sys.path.insert(0, ROOT)
+os.environ['SCHEMA_FP'] = os.path.join(FIXTURES, 'schema.json')
+os.environ['NAMES_FP'] = os.path.join(FIXTURES, 'names.json')
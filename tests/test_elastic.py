@@ -0,0 +1,75 @@
+"""
+the compiled measure filters (`compile_measure_filter`) match the same facts as
+the original formulation, for every dimension selection of the fixture schema
+"""
+
+
+from itertools import chain, combinations, product
+
+import pytest
+
+from elastic import compile_measure_filter, freeze_dimensions
+from fake_elastic import match
+from schema import Schema
+
+
+def get_measure_filter_before(measure, dimensions, schema):
+    """the measure filter before it was compiled and memoised"""
+    other_dimensions = set(d.key for d in schema[measure]) - set(dimensions.keys())
+    if not dimensions:
+        return {'bool': {
+            'must': {'exists': {'field': measure}},
+            'must_not': [{'exists': {'field': d}} for d in other_dimensions]
+        }}
+    not_values = {}
+    for dimension, values in dimensions.items():
+        if values:
+            not_values['path.%s.%s.keyword' % (measure, dimension)] = list(
+                set(v.key for v in schema[measure][dimension]) - set(values))
+    should = []
+    for dimension, values in dimensions.items():
+        field = 'path.%s.%s' % (measure, dimension)
+        should.append({'terms': {'%s.keyword' % field: values}} if values else {'exists': {'field': field}})
+    return {'bool': {
+        'should': should,
+        'must_not': [{'exists': {'field': 'path.%s.%s' % (measure, d)}} for d in other_dimensions] + [
+            {'terms': {k: v}} for k, v in not_values.items()]
+    }}
+
+
+def subsets(items, min_size=0):
+    items = list(items)
+    return chain.from_iterable(combinations(items, n) for n in range(min_size, len(items) + 1))
+
+
+def get_facts(statistic):
+    """one fact per measure of `statistic` and every combination of its dimension values"""
+    facts = []
+    for measure in statistic:
+        for dimensions in subsets(d.key for d in measure):
+            for values in product(*[[v.key for v in measure[d]] for d in dimensions]):
+                path = dict(zip(dimensions, values))
+                facts.append({'statistic': statistic.key, measure.key: {'value': 1},
+                              'path': {measure.key: path}, **path})
+    return facts
+
+
+def get_selections():
+    """every selection `{dimension: [values]}` (no values: all) of every measure"""
+    for statistic in Schema:
+        for measure in statistic:
+            for dimensions in subsets(d.key for d in measure):
+                choices = [[()] + list(subsets([v.key for v in measure[d]], 1)) for d in dimensions]
+                for values in product(*choices):
+                    yield statistic, measure, {d: list(v) for d, v in zip(dimensions, values)}
+
+
+@pytest.mark.parametrize('statistic, measure, dimensions', [
+    pytest.param(s, m, d, id=f'{s.key}:{m.key}{d}') for s, m, d in get_selections()])
+def test_compiled_measure_filter_matches_the_same_facts(statistic, measure, dimensions):
+    facts = get_facts(statistic)
+    before = get_measure_filter_before(measure.key, dimensions, Schema[statistic.key])
+    compiled = compile_measure_filter(statistic.key, measure.key, freeze_dimensions(dimensions))
+    expected = [match(f, before) for f in facts]
+    assert any(expected)
+    assert [match(f, compiled) for f in facts] == expected
@@ -1,12 +1,44 @@
 import sys
+import threading
+import time
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 
 def tree():
     return defaultdict(tree)
 
 
+class TTLCache:
+    """
+    minimal in-process key/value store whose entries expire after `ttl` seconds.
+    if it grows beyond `maxsize` entries, the oldest ones are dropped.
+    """
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # in order of expiry, as all entries live for `ttl`
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+
 # https://docs.djangoproject.com/en/2.2/ref/utils/#module-django.utils.functional
 class cached_property:
     """
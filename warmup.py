@@ -0,0 +1,131 @@
+"""
+warm up the cache after a data reload: build and store the base and concrete
+entries for the whole schema (statistics x measures x region levels) and/or
+replay the queries of the most recent concrete entries of the cache index.
+
+    python warmup.py --schema --replay 1000 --concurrency 4 --state warmup.state
+
+queries that share a base table are built together, so every base table is
+scanned from elasticsearch only once. every finished group is appended to
+the `--state` file, a restarted job skips them.
+"""
+
+
+import argparse
+import sys
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache import Cache
+from exceptions import ValidationError
+from query import Query
+from schema import Schema
+from settings import WARMUP_CONCURRENCY
+from workers import materialize
+
+
+def get_schema_queries(times=('latest',)):
+    for statistic in Schema:
+        for measure in statistic:
+            for level in measure.region_levels:
+                for time_ in times:
+                    yield f'data={statistic.key}:{measure.key}&level={level}&time={time_}'
+
+
+def get_replay_queries(size):
+    """urlqueries of the `size` most recently created concrete entries"""
+    res = Cache.backend.client.search(index=Cache.backend.index, body={
+        'query': {'term': {'kind': 'concrete'}},
+        'sort': [{'created': 'desc'}],
+        '_source': ['urlquery'],
+        'size': size
+    })
+    for hit in res['hits']['hits']:
+        yield hit['_source']['urlquery']
+
+
+def group_queries(urlqueries):
+    """valid queries grouped by the key of their base table"""
+    groups = defaultdict(dict)
+    for urlquery in urlqueries:
+        try:
+            query = Query(urlquery)
+        except ValidationError as e:
+            print(f'skipping `{urlquery}`: {e}', file=sys.stderr)
+            continue
+        groups[query.data_key][query.key] = query
+    return {k: list(v.values()) for k, v in groups.items()}
+
+
+class Progress:
+    def __init__(self, total, state=None):
+        self.total = total
+        self.done = self.failed = self.rows = 0
+        self.state = state
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, key, rows=None):
+        with self._lock:
+            if rows is None:
+                self.failed += 1
+            else:
+                self.done += 1
+                self.rows += rows
+                if self.state:
+                    self.state.write(key + '\n')
+                    self.state.flush()
+            elapsed = time.monotonic() - self.started
+            print(f'[{self.done + self.failed}/{self.total}] {self.failed} failed, '
+                  f'{self.done / elapsed:.2f} tables/s, {self.rows / elapsed:.0f} rows/s', file=sys.stderr)
+
+
+def warmup(urlqueries, concurrency=WARMUP_CONCURRENCY, state_file=None, force=False):
+    groups = group_queries(urlqueries)
+    if state_file:
+        try:
+            with open(state_file) as f:
+                finished = set(f.read().split())
+        except FileNotFoundError:
+            finished = set()
+        groups = {k: v for k, v in groups.items() if k not in finished}
+    state = open(state_file, 'a') if state_file else None
+    progress = Progress(len(groups), state)
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = {executor.submit(materialize, queries, force): key for key, queries in groups.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f'failed {[q.urlquery for q in groups[key]]}: {e!r}', file=sys.stderr)
+                    rows = None
+                progress.update(key, rows)
+    finally:
+        if state:
+            state.close()
+    return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='warm up the tabular cache')
+    parser.add_argument('--schema', action='store_true', help='all statistics x measures x region levels')
+    parser.add_argument('--time', action='append', help='time argument for the schema queries (default: latest)')
+    parser.add_argument('--replay', type=int, default=0, help='replay the N most recent cached queries')
+    parser.add_argument('--concurrency', type=int, default=WARMUP_CONCURRENCY)
+    parser.add_argument('--state', help='file to record finished base tables in, to resume an interrupted job')
+    parser.add_argument('--force', action='store_true', help='rebuild existing cache entries')
+    args = parser.parse_args()
+
+    urlqueries = []
+    if args.schema:
+        urlqueries += get_schema_queries(args.time or ['latest'])
+    if args.replay:
+        urlqueries += get_replay_queries(args.replay)
+    if not urlqueries:
+        parser.error('nothing to do, use `--schema` and/or `--replay N`')
+    progress = warmup(urlqueries, args.concurrency, args.state, args.force)
+    sys.exit(1 if progress.failed else 0)
@@ -0,0 +1,196 @@
+"""
+build and render large tables in a bounded pool of worker processes, so that
+the pandas work of one big request doesn't hold the GIL of all other request
+threads of this process.
+
+the frames are moved to the workers via shared memory: their numeric column
+buffers (values, categorical codes) are pickled out-of-band into one shared
+memory segment and only the small rest (column names, categories, ...) goes
+through the pipe.
+"""
+
+
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+from cache import Cache
+from cost import QueryCost
+from elastic import ElasticQuery
+from exceptions import Overloaded
+from query import Query
+from settings import (WORKER_PROCESSES, WORKER_QUEUE_SIZE, WORKER_MIN_ROWS,
+                      HEAVY_WORKER_PROCESSES, HEAVY_WORKER_QUEUE_SIZE)
+from table import Table, encode_orderings, load_orderings
+
+
+class SharedFrame:
+    def __init__(self, df):
+        # object columns (region ids, years) travel as categoricals so that they are mostly integer codes
+        self.object_columns = [c for c in df.columns if df[c].dtype == object]
+        df = df.astype({c: 'category' for c in self.object_columns})
+        buffers = []
+        self.data = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+        self.sizes = [b.nbytes for b in buffers]
+        self._shm = SharedMemory(create=True, size=max(sum(self.sizes), 1))
+        self.name = self._shm.name
+        offset = 0
+        for buffer in buffers:
+            self._shm.buf[offset:offset + buffer.nbytes] = buffer
+            offset += buffer.nbytes
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_shm'}
+
+    def load(self):
+        """the DataFrame, copied out of the shared memory (to be called in the worker process)"""
+        shm = SharedMemory(name=self.name)
+        try:
+            # one plain copy per column buffer, the unpickled arrays then own their memory
+            buffers = []
+            offset = 0
+            for size in self.sizes:
+                buffers.append(bytearray(shm.buf[offset:offset + size]))
+                offset += size
+        finally:
+            shm.close()
+        df = pickle.loads(self.data, buffers=buffers)
+        return df.astype({c: object for c in self.object_columns})
+
+    def release(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def process_table(table, paging=None, with_base=True):
+    """
+    process and render `table`, returns the concrete cache entry, the base
+    cache entry (if `with_base`) and the requested page (if `paging`)
+    """
+    concrete = table.serialize()
+    base = table.serialize_base() if with_base else None
+    page = table.paginated(*paging) if paging else None
+    return concrete, base, page
+
+
+def _process_shared(shared, urlquery, from_base, cubes, orderings, paging, with_base):
+    df = shared.load()
+    table = Table(df, Query(urlquery), from_base, cubes=cubes, orderings=orderings)
+    # the orderings computed here go back with the result
+    return process_table(table, paging, with_base), table._orderings
+
+
+class WorkerPool:
+    def __init__(self, processes, queue_size):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # `spawn`: forking a process with running request threads is not safe
+            self._executor = ProcessPoolExecutor(self.processes, mp_context=get_context('spawn'))
+        return self._executor
+
+    @contextmanager
+    def slot(self):
+        """one of the `queue_size` slots of this pool, raises `Overloaded` if none is left"""
+        with self._lock:
+            if self.pending >= self.queue_size:
+                raise Overloaded('Too many large tables in progress, please try again later.')
+            self.pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def process(self, table, paging=None, with_base=True, reserved=False):
+        """
+        like `process_table`, but in a worker process if the pool is enabled
+        and the table is large enough. raises `Overloaded` if too many tables
+        are already queued. if a `slot` is already `reserved` by the caller,
+        the table is processed in this pool regardless of its size.
+        """
+        if not self.processes or (not reserved and len(table._df) < WORKER_MIN_ROWS):
+            return process_table(table, paging, with_base)
+        if reserved:
+            return self._process(table, paging, with_base)
+        with self.slot():
+            return self._process(table, paging, with_base)
+
+    def _process(self, table, paging, with_base):
+        shared = SharedFrame(table._df)
+        executor = self.executor
+        try:
+            future = executor.submit(_process_shared, shared, table.query.urlquery, table._from_base,
+                                     getattr(table, 'cubes', []), table._orderings, paging, with_base)
+            result, orderings = future.result()
+            table._orderings.update(orderings)
+            return result
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for its memory), the pool is unusable and started anew
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise Overloaded('A large table could not be processed, please try again later.')
+        finally:
+            shared.release()
+
+
+Workers = WorkerPool(WORKER_PROCESSES, WORKER_QUEUE_SIZE)
+# separate lane for queries estimated as heavy (see `cost.py`), its slots are held from scanning to rendering
+HeavyWorkers = WorkerPool(HEAVY_WORKER_PROCESSES, HEAVY_WORKER_QUEUE_SIZE)
+
+
+def materialize(queries, force=False, lanes=False):
+    """
+    build and store the concrete entries of `queries` (all sharing one base
+    table) and their base entry, returns the number of fact rows. existing
+    entries are kept unless `force`. with `lanes`, the tables are estimated
+    and processed in the worker pools like the requests of the app (raises
+    `ValidationError` or `Overloaded`).
+    """
+    base_data = None if force else Cache.get(queries[0].data_key)
+    # the rows of the base table are sorted once per `sort` and `labels`
+    orderings = load_orderings(base_data) if base_data else {}
+    stored = set(orderings)
+    rows = 0
+    for query in queries:
+        if not force and Cache.get(query.key):
+            continue
+        pool = Workers
+        with ExitStack() as lane:
+            if base_data:
+                table = Table.from_base(base_data, query, orderings=orderings)
+            else:
+                es = ElasticQuery(query.cleaned_data)
+                if lanes:
+                    cost = QueryCost(query, es)
+                    cost.validate()
+                    if cost.heavy:
+                        pool = HeavyWorkers
+                        lane.enter_context(pool.slot())
+                table = Table(es.facts, query, orderings=orderings)
+            if lanes:
+                concrete, base, _ = pool.process(table, with_base=base_data is None, reserved=pool is HeavyWorkers)
+            else:
+                concrete, base, _ = process_table(table, with_base=base_data is None)
+        Cache.set(query.key, concrete)
+        if base is not None:
+            Cache.set(query.data_key, base)
+            base_data = base
+            stored = set(orderings)
+        rows += len(table._df)
+    if base_data and set(orderings) - stored:
+        Cache.update(queries[0].data_key, {'orderings': encode_orderings(orderings, base_data['created'])})
+    return rows